@@ -0,0 +1,224 @@
+"""Throughput benchmarks for ohneio.
+
+Run with ``python bench_ohneio.py``. Results can be written as JSON with ``--output``, and
+compared against a previous run with ``--baseline``.
+"""
+import argparse
+import collections
+import json
+import platform
+import random
+import sys
+import timeit
+
+import ohneio
+
+
+TOTAL_SIZE = 1 << 20  # Amount of data processed by each benchmark
+
+SEGMENT_SIZES = collections.OrderedDict([
+    ('small', lambda rng: 16),
+    ('large', lambda rng: 65536),
+    ('mixed', lambda rng: rng.choice([1, 16, 100, 1500, 4096, 65536])),
+])
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    """Register a benchmark.
+
+    A benchmark function returns a function running one iteration, and the amount of bytes one
+    iteration processes.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def segments(distribution, total=TOTAL_SIZE, line_length=0):
+    """Split ``total`` bytes of data in segments, according to a size distribution."""
+    rng = random.Random(42)
+    if line_length > 0:
+        line = b'x' * (line_length - 1) + b'\n'
+        data = line * (total // line_length)
+    else:
+        data = bytes(total)
+    result = []
+    start = 0
+    while start < len(data):
+        size = SEGMENT_SIZES[distribution](rng)
+        result.append(data[start:start + size])
+        start += size
+    return result
+
+
+@ohneio.protocol
+def echo_n_bytes(nbytes):
+    while True:
+        data = yield from ohneio.read(nbytes)
+        yield from ohneio.write(data)
+
+
+@ohneio.protocol
+def line_echo():
+    while True:
+        line = yield from ohneio.readline()
+        yield from ohneio.write(line)
+
+
+def _register_buffer_benchmarks(distribution):
+    @benchmark('buffer_write_read_{}'.format(distribution))
+    def buffer_write_read():
+        chunks = segments(distribution)
+
+        def run():
+            buf = ohneio.Buffer()
+            for chunk in chunks:
+                buf.write(chunk)
+            while len(buf) > 0:
+                buf.read(4096)
+        return run, TOTAL_SIZE
+
+    @benchmark('compact_buffer_write_read_{}'.format(distribution))
+    def compact_buffer_write_read():
+        chunks = segments(distribution)
+
+        def run():
+            buf = ohneio.CompactBuffer()
+            for chunk in chunks:
+                buf.write(chunk)
+            while len(buf) > 0:
+                buf.read(4096)
+        return run, TOTAL_SIZE
+
+    @benchmark('buffer_peek_{}'.format(distribution))
+    def buffer_peek():
+        buf = ohneio.Buffer()
+        for chunk in segments(distribution):
+            buf.write(chunk)
+
+        def run():
+            for i in range(256):
+                buf.peek(4096)
+        return run, 256 * 4096
+
+
+def _register_consumer_benchmarks(distribution):
+    @benchmark('echo_n_bytes_{}'.format(distribution))
+    def echo():
+        chunks = segments(distribution)
+
+        def run():
+            conn = echo_n_bytes(1024)
+            for chunk in chunks:
+                conn.send(chunk)
+                conn.read()
+        return run, TOTAL_SIZE
+
+    @benchmark('line_echo_{}'.format(distribution))
+    def lines():
+        chunks = segments(distribution, line_length=80)
+
+        def run():
+            conn = line_echo()
+            for chunk in chunks:
+                conn.send(chunk)
+                conn.read()
+        return run, TOTAL_SIZE
+
+
+@ohneio.protocol
+def byte_writer(nbytes):
+    for i in range(nbytes):
+        yield from ohneio.write_nowait(b'x')
+
+
+def _register_driver_benchmarks(checked):
+    @benchmark('resumptions_{}'.format('checked' if checked else 'unchecked'))
+    def resumptions():
+        # The protocol is resumed once per byte, without waiting for anything, so this measures
+        # the overhead of resuming it.
+        nbytes = TOTAL_SIZE // 16
+
+        def run():
+            conn = ohneio.Consumer(byte_writer.__wrapped__(nbytes), checked=checked)
+            conn.read()
+        return run, nbytes
+
+
+for _checked in [True, False]:
+    _register_driver_benchmarks(_checked)
+
+for _distribution in SEGMENT_SIZES:
+    _register_buffer_benchmarks(_distribution)
+    _register_consumer_benchmarks(_distribution)
+
+
+def run_benchmarks(names, repeat):
+    results = collections.OrderedDict()
+    for name in names:
+        run, nbytes = BENCHMARKS[name]()
+        timings = timeit.repeat(run, repeat=repeat, number=1)
+        best = min(timings)
+        results[name] = {
+            'best': best,
+            'mean': sum(timings) / len(timings),
+            'bytes': nbytes,
+            'throughput': nbytes / best,
+        }
+        print('{:<30} {:>10.2f} ms {:>10.1f} MB/s'.format(
+            name, best * 1000, nbytes / best / 1e6))
+    return results
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['best'] / baseline[name]['best']
+        print('{:<30} {:>9.2f}x'.format(name, ratio))
+        if ratio > 1 + max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare the results to this JSON file")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="slowdown ratio tolerated against the baseline (default: 0.2)")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per benchmark (default: 5)")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all)")
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(', '.join(sorted(unknown))))
+
+    results = run_benchmarks(names, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'benchmarks': results,
+            }, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['benchmarks']
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print("Regressions: {}".format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2421 @@
+import collections
+import functools
+import inspect
+import itertools
+import mmap
+import os
+import struct
+import time
+import typing
+
+
+class Buffer(typing.Sized):
+    def __init__(self) -> None:
+        self.queue = collections.deque()  # type: collections.deque[bytes]
+        self.position = 0
+        self.length = 0
+
+    def write(self, chunk: bytes) -> None:
+        if len(chunk) == 0:
+            return
+        self.queue.append(chunk)
+        self.length += len(chunk)
+
+    def _get_segments(self, nbytes: int) -> typing.Tuple[int, int, typing.List[bytes]]:
+        """Gather ``nbytes`` from the head of the queue, without copying them.
+
+        Only the segments actually containing the requested bytes are visited.
+
+        Returns:
+            tuple: ``(segments, position, pieces)``, where ``segments`` is the amount of segments
+            entirely consumed by the read, ``position`` the new position in the first remaining
+            segment, and ``pieces`` the segments (or views on the segments) holding the data.
+        """
+        assert len(self.queue) > 0 or self.position == 0, ("We can't have a positive position "
+                                                           "on an empty queue.")
+
+        if nbytes == 0 or nbytes > self.length:
+            nbytes = self.length
+        if nbytes == 0:
+            return 0, 0, []
+
+        first = self.queue[0]
+        end = self.position + nbytes
+        if end <= len(first):
+            pieces = [_slice(first, self.position, end)]
+            if end == len(first):
+                return 1, 0, pieces
+            return 0, end, pieces
+
+        pieces = [_slice(first, self.position, len(first))]
+        to_read = nbytes - len(pieces[0])
+        segments = 1
+        for segment in itertools.islice(self.queue, 1, None):
+            if len(segment) > to_read:
+                pieces.append(_slice(segment, 0, to_read))
+                return segments, to_read, pieces
+            pieces.append(segment)
+            segments += 1
+            to_read -= len(segment)
+            if to_read == 0:
+                break
+        return segments, 0, pieces
+
+    def _consume(self, segments: int, position: int, nbytes: int) -> None:
+        for i in range(segments):
+            self.queue.popleft()
+        self.position = position
+        self.length -= nbytes
+
+        assert len(self.queue) > 0 or self.position == 0, ("We can't have a positive position "
+                                                           "on an empty queue.")
+
+    def find(self, sub: bytes, start: int=0, end: typing.Optional[int]=None) -> int:
+        """Find ``sub`` in the buffer, even when it spans several segments.
+
+        Only the bytes between ``start`` and ``end`` are scanned, this allows callers to resume
+        a search where they left it.
+
+        Returns:
+            int: the lowest index where ``sub`` is found, or ``-1``.
+        """
+        return self._find(sub, start, end, None)[0]
+
+    def _find(self, sub: bytes, start: int, end: typing.Optional[int],
+              cursor: typing.Optional[typing.Tuple[int, int]]
+              ) -> typing.Tuple[int, typing.Optional[typing.Tuple[int, int]]]:
+        """Like :meth:`find`, starting from the segment ``cursor`` returned by a previous call.
+
+        The cursor is ``(index, offset)`` of the last segment scanned, so resuming a search
+        doesn't walk the queue from its head again. It is only valid until data is consumed.
+
+        Returns:
+            tuple: ``(pos, cursor)``.
+        """
+        if end is None or end > self.length:
+            end = self.length
+        overlap = len(sub) - 1
+        if overlap < 0:
+            return (start if start <= end else -1), cursor
+        if end - start <= overlap:
+            return -1, cursor
+
+        queue = self.queue
+        if cursor is None:
+            index, segment_start = 0, -self.position
+        else:
+            index, segment_start = cursor
+            while segment_start > start and index > 0:
+                index -= 1
+                segment_start -= len(queue[index])
+
+        tail = b''  # Last bytes of the previous segments, for matches across boundaries
+        tail_start = 0
+        while index < len(queue):
+            segment = queue[index]
+            segment_end = segment_start + len(segment)
+            if segment_start >= end:
+                break
+            if segment_end <= start:
+                segment_start = segment_end
+                index += 1
+                continue
+
+            cursor = (index, segment_start)
+            base = segment_start
+            lo = max(start - segment_start, 0)
+            hi = min(end - segment_start, len(segment))
+            if not hasattr(segment, 'find'):  # memoryview, only copy the bytes scanned
+                segment = bytes(segment[lo:hi])
+                base += lo
+                lo, hi = 0, hi - lo
+
+            if tail:
+                pos = (tail + segment[:min(overlap, hi)]).find(sub)
+                if pos >= 0:
+                    return tail_start + pos, cursor
+
+            pos = segment.find(sub, lo, hi)
+            if pos >= 0:
+                return base + pos, cursor
+
+            if overlap > 0:
+                tail = (tail + segment[max(lo, hi - overlap):hi])[-overlap:]
+                tail_start = base + hi - len(tail)
+            segment_start = segment_end
+            index += 1
+        return -1, cursor
+
+    def peek(self, nbytes: int=0) -> bytes:
+        _, _, pieces = self._get_segments(nbytes)
+        return _join(pieces)
+
+    def read(self, nbytes: int=0) -> bytes:
+        segments, position, pieces = self._get_segments(nbytes)
+        data = _join(pieces)
+        self._consume(segments, position, len(data))
+        return data
+
+    def peek_view(self, nbytes: int=0) -> memoryview:
+        """Like :meth:`peek`, but without copying when the data is in a single segment."""
+        _, _, pieces = self._get_segments(nbytes)
+        return _view(pieces)
+
+    def read_view(self, nbytes: int=0) -> memoryview:
+        """Like :meth:`read`, but without copying when the data is in a single segment."""
+        segments, position, pieces = self._get_segments(nbytes)
+        view = _view(pieces)
+        self._consume(segments, position, len(view))
+        return view
+
+    def readinto(self, buffer: typing.Union[bytearray, memoryview]) -> int:
+        """Read and consume data directly into a writable buffer.
+
+        Returns:
+            int: amount of bytes written into the buffer.
+        """
+        target = memoryview(buffer)
+        if len(target) == 0:
+            return 0
+        segments, position, pieces = self._get_segments(len(target))
+        nbytes = 0
+        for piece in pieces:
+            target[nbytes:nbytes + len(piece)] = _materialize(piece)
+            nbytes += len(piece)
+        self._consume(segments, position, nbytes)
+        return nbytes
+
+    def segments(self, max_bytes: int=0) -> typing.List[bytes]:
+        """Get the queued segments without joining nor consuming them.
+
+        Args:
+            max_bytes (:obj:`int`, optional): amount of bytes covered by the segments *at most*.
+                ``0`` means all the segments.
+
+        Returns:
+            list: segments, or views on the segments, in order. Ranges of files are
+            :class:`~ohneio.FileSegment` objects.
+        """
+        _, _, pieces = self._get_segments(max_bytes)
+        return pieces
+
+    def consume(self, nbytes: int) -> None:
+        """Drop ``nbytes`` from the head of the buffer."""
+        if nbytes <= 0:
+            return
+        if nbytes > self.length:
+            raise ValueError("Can't consume {} bytes, only {} available".format(
+                nbytes, self.length))
+        if self.position + nbytes < len(self.queue[0]):
+            self.position += nbytes
+            self.length -= nbytes
+            return
+        segments, position, _ = self._get_segments(nbytes)
+        self._consume(segments, position, nbytes)
+
+    def peek_struct(self, fmt: struct.Struct) -> tuple:
+        """Unpack a structure from the head of the buffer, without consuming it.
+
+        The structure is unpacked in place when it lies in a single segment.
+        """
+        if fmt.size > self.length:
+            raise ValueError("Can't unpack {} bytes, only {} available".format(
+                fmt.size, self.length))
+        first = self.queue[0] if self.queue else b''
+        if self.position + fmt.size <= len(first):
+            return fmt.unpack_from(first, self.position)
+        return fmt.unpack(self.peek(fmt.size))
+
+    def read_struct(self, fmt: struct.Struct) -> tuple:
+        """Unpack a structure from the head of the buffer, and consume it."""
+        values = self.peek_struct(fmt)
+        self.consume(fmt.size)
+        return values
+
+    def peek_varint(self, max_size: int=10) -> typing.Optional[typing.Tuple[int, int]]:
+        """Decode an unsigned LEB128 integer from the head of the buffer, without consuming it.
+
+        Returns:
+            tuple: ``(value, size)``, or ``None`` when the integer isn't complete yet.
+
+        Raises:
+            LimitExceeded: When the integer is longer than ``max_size`` bytes.
+        """
+        value = 0
+        size = 0
+        start = self.position
+        for segment in self.queue:
+            for i in range(start, len(segment)):
+                byte = segment[i]
+                value |= (byte & 0x7f) << (7 * size)
+                size += 1
+                if byte < 0x80:
+                    return value, size
+                if size >= max_size:
+                    raise LimitExceeded("Variable length integer longer than {} bytes".format(
+                        max_size))
+            start = 0
+        return None
+
+    @property
+    def segment_count(self) -> int:
+        """int: Amount of segments queued"""
+        return len(self.queue)
+
+    @property
+    def capacity(self) -> int:
+        """int: Amount of bytes still buffered
+
+        The segments are dropped by :meth:`clear`, so unlike :attr:`CompactBuffer.capacity`, this
+        isn't memory kept by a buffer waiting in a :class:`~ohneio.BufferPool`.
+        """
+        return self.length
+
+    def clear(self) -> None:
+        """Drop all the data, so the buffer can be reused."""
+        self.queue.clear()
+        self.position = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __repr__(self) -> str:
+        return '<{self.__class__.__name__} {self.queue!r} pos={self.position}>'.format(self=self)
+
+
+class MmapBuffer(Buffer):
+    """Buffer exposing a memory-mapped file.
+
+    The whole file is a single segment of the buffer. Unlike :class:`~ohneio.Buffer`,
+    :meth:`read` and :meth:`peek` return :class:`memoryview` objects on the mapping when possible,
+    so parsing the file doesn't copy it.
+
+    The mapping can only be closed once no view on it is used anymore.
+
+    Args:
+        path (str): path of the file to map.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.mmap = None  # type: typing.Optional[mmap.mmap]
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size > 0:  # Empty files can't be mapped
+                self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap is not None:
+            self.write(self.mmap)
+
+    def peek(self, nbytes: int=0) -> bytes:
+        return self.peek_view(nbytes)
+
+    def read(self, nbytes: int=0) -> bytes:
+        return self.read_view(nbytes)
+
+    def close(self) -> None:
+        """Close the mapping."""
+        self.clear()
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+class CompactBuffer(typing.Sized):
+    """Buffer storing its data contiguously, in a single :class:`bytearray`.
+
+    Unlike :class:`~ohneio.Buffer`, which queues the chunks written, chunks are copied at the end
+    of the array. This costs a copy per write, but saves an object per chunk and keeps the data
+    contiguous, which is faster when the data comes in many small chunks. For large chunks,
+    :class:`~ohneio.Buffer` is faster, since it doesn't copy them.
+
+    Consumed bytes are dropped from the head of the array once there are more than
+    ``max_waste`` of them, and more of them than bytes still buffered, so compacting the array
+    only moves a small amount of data.
+
+    A :class:`bytearray` can't be resized while views on it exist, so the views returned by
+    :meth:`peek_view`, :meth:`read_view` and :meth:`segments` are views on copies of the data.
+
+    Args:
+        max_waste (:obj:`int`, optional): amount of consumed bytes kept at most at the head of
+            the array, as long as they are less than the bytes buffered.
+
+    Example:
+
+        >>> buf = CompactBuffer()
+        >>> buf.write(b'Hello ')
+        >>> buf.write(b'World')
+        >>> buf.read(8)
+        b'Hello Wo'
+        >>> len(buf)
+        3
+    """
+    __slots__ = ('data', 'start', 'max_waste')
+
+    def __init__(self, max_waste: int=4096) -> None:
+        self.data = bytearray()
+        self.start = 0
+        self.max_waste = max_waste
+
+    def write(self, chunk: bytes) -> None:
+        if len(chunk) == 0:
+            return
+        self.data += _materialize(chunk)
+
+    def _copy(self, nbytes: int) -> bytes:
+        length = len(self.data) - self.start
+        if nbytes == 0 or nbytes > length:
+            nbytes = length
+        with memoryview(self.data) as view:
+            return bytes(view[self.start:self.start + nbytes])
+
+    def _advance(self, nbytes: int) -> None:
+        self.start += nbytes
+        if self.start == len(self.data):
+            del self.data[:]
+            self.start = 0
+        elif self.start > self.max_waste and self.start > len(self.data) - self.start:
+            del self.data[:self.start]
+            self.start = 0
+
+    def find(self, sub: bytes, start: int=0, end: typing.Optional[int]=None) -> int:
+        """Find ``sub`` in the buffer, see :meth:`Buffer.find`."""
+        length = len(self.data) - self.start
+        if end is None or end > length:
+            end = length
+        pos = self.data.find(sub, self.start + start, self.start + end)
+        return pos - self.start if pos >= 0 else -1
+
+    def _find(self, sub: bytes, start: int, end: typing.Optional[int],
+              cursor: typing.Any) -> typing.Tuple[int, None]:
+        return self.find(sub, start, end), None
+
+    def peek(self, nbytes: int=0) -> bytes:
+        return self._copy(nbytes)
+
+    def read(self, nbytes: int=0) -> bytes:
+        data = self._copy(nbytes)
+        self._advance(len(data))
+        return data
+
+    def peek_view(self, nbytes: int=0) -> memoryview:
+        """Like :meth:`peek`, but returns a view on the copy."""
+        return memoryview(self._copy(nbytes))
+
+    def read_view(self, nbytes: int=0) -> memoryview:
+        """Like :meth:`read`, but returns a view on the copy."""
+        return memoryview(self.read(nbytes))
+
+    def readinto(self, buffer: typing.Union[bytearray, memoryview]) -> int:
+        """Read and consume data directly into a writable buffer.
+
+        Returns:
+            int: amount of bytes written into the buffer.
+        """
+        target = memoryview(buffer)
+        nbytes = min(len(target), len(self.data) - self.start)
+        if nbytes == 0:
+            return 0
+        with memoryview(self.data) as view:
+            target[:nbytes] = view[self.start:self.start + nbytes]
+        self._advance(nbytes)
+        return nbytes
+
+    def segments(self, max_bytes: int=0) -> typing.List[bytes]:
+        """Get the buffered data, as a single segment, without consuming it.
+
+        Returns:
+            list: a copy of the data, or nothing when the buffer is empty.
+        """
+        data = self._copy(max_bytes)
+        return [data] if data else []
+
+    def consume(self, nbytes: int) -> None:
+        """Drop ``nbytes`` from the head of the buffer."""
+        if nbytes <= 0:
+            return
+        length = len(self.data) - self.start
+        if nbytes > length:
+            raise ValueError("Can't consume {} bytes, only {} available".format(nbytes, length))
+        self._advance(nbytes)
+
+    def peek_struct(self, fmt: struct.Struct) -> tuple:
+        """Unpack a structure from the head of the buffer, without consuming it."""
+        length = len(self.data) - self.start
+        if fmt.size > length:
+            raise ValueError("Can't unpack {} bytes, only {} available".format(
+                fmt.size, length))
+        return fmt.unpack_from(self.data, self.start)
+
+    def read_struct(self, fmt: struct.Struct) -> tuple:
+        """Unpack a structure from the head of the buffer, and consume it."""
+        values = self.peek_struct(fmt)
+        self._advance(fmt.size)
+        return values
+
+    def peek_varint(self, max_size: int=10) -> typing.Optional[typing.Tuple[int, int]]:
+        """Decode an unsigned LEB128 integer, see :meth:`Buffer.peek_varint`."""
+        value = 0
+        size = 0
+        data = self.data
+        for i in range(self.start, len(data)):
+            byte = data[i]
+            value |= (byte & 0x7f) << (7 * size)
+            size += 1
+            if byte < 0x80:
+                return value, size
+            if size >= max_size:
+                raise LimitExceeded("Variable length integer longer than {} bytes".format(
+                    max_size))
+        return None
+
+    @property
+    def segment_count(self) -> int:
+        """int: Amount of segments, ``1`` unless the buffer is empty"""
+        return 1 if len(self.data) > self.start else 0
+
+    @property
+    def capacity(self) -> int:
+        """int: Amount of memory allocated by the array, in bytes"""
+        return self.data.__alloc__()
+
+    def clear(self) -> None:
+        """Drop all the data, so the buffer can be reused."""
+        del self.data[:]
+        self.start = 0
+
+    def __len__(self) -> int:
+        return len(self.data) - self.start
+
+    def __repr__(self) -> str:
+        return '<{self.__class__.__name__} {data!r}>'.format(self=self, data=self.peek())
+
+
+class BufferPool:
+    """Pool of buffers reused by consumers.
+
+    Consumers created with ``pool=`` take their buffers from the pool, and give them back once
+    their protocol ended, or once they are closed. This spares allocating new buffers for every
+    short-lived connection.
+
+    Args:
+        factory (:obj:`callable`, optional): called without arguments when the pool is empty, to
+            create a new buffer.
+        max_size (:obj:`int`, optional): maximum amount of buffers kept in the pool.
+        max_capacity (:obj:`int`, optional): buffers whose ``capacity`` is above
+            ``max_capacity`` bytes when they are given back are dropped, instead of being kept in
+            the pool. This is the memory allocated by a :class:`~ohneio.CompactBuffer`, and the
+            bytes still buffered by a :class:`~ohneio.Buffer`.
+
+    Attributes:
+        hits (int): amount of buffers taken from the pool.
+        misses (int): amount of buffers created because the pool was empty.
+        discards (int): amount of buffers given back, but not kept in the pool.
+
+    Example:
+
+        >>> pool = BufferPool()
+        >>> @protocol(pool=pool)
+        ... def hello():
+        ...     yield from write(b'Hello')
+        ...
+        >>> for i in range(3):
+        ...     hello().read()
+        b'Hello'
+        b'Hello'
+        b'Hello'
+        >>> pool.hits, pool.misses
+        (4, 2)
+    """
+
+    def __init__(self, factory: typing.Callable[[], typing.Any]=Buffer, *, max_size: int=1024,
+                 max_capacity: int=65536) -> None:
+        self.factory = factory
+        self.max_size = max_size
+        self.max_capacity = max_capacity
+        self.buffers = []  # type: typing.List[typing.Any]
+        self.hits = 0
+        self.misses = 0
+        self.discards = 0
+
+    def acquire(self) -> typing.Any:
+        """Take a buffer from the pool, or create one."""
+        if self.buffers:
+            self.hits += 1
+            return self.buffers.pop()
+        self.misses += 1
+        return self.factory()
+
+    def release(self, buffer: typing.Any) -> None:
+        """Give a buffer back to the pool. Its data is dropped."""
+        if len(self.buffers) >= self.max_size or buffer.capacity > self.max_capacity:
+            self.discards += 1
+            return
+        buffer.clear()
+        self.buffers.append(buffer)
+
+    def __len__(self) -> int:
+        return len(self.buffers)
+
+
+class FileSegment:
+    """Range of a file, queued in a buffer without being read.
+
+    Drivers can send it with :func:`os.sendfile`, so the content of the file never goes through
+    Python. Otherwise, it is read with :func:`os.pread` when its bytes are needed.
+
+    The file has to stay open until the segment is consumed.
+
+    Args:
+        fileobj: binary file object, or anything with a ``fileno()`` method.
+        offset (:obj:`int`, optional): position of the range in the file.
+        count (:obj:`int`, optional): size of the range. Defaults to the rest of the file.
+    """
+    __slots__ = ('fileobj', 'offset', 'count')
+
+    def __init__(self, fileobj: typing.Any, offset: int=0,
+                 count: typing.Optional[int]=None) -> None:
+        if count is None:
+            count = max(os.fstat(fileobj.fileno()).st_size - offset, 0)
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+
+    def fileno(self) -> int:
+        return self.fileobj.fileno()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: slice) -> 'FileSegment':
+        start, stop, step = index.indices(self.count)
+        assert step == 1, "File segments can only be sliced contiguously"
+        return FileSegment(self.fileobj, self.offset + start, max(stop - start, 0))
+
+    def __bytes__(self) -> bytes:
+        pieces = []
+        nread = 0
+        while nread < self.count:
+            data = os.pread(self.fileno(), self.count - nread, self.offset + nread)
+            if not data:
+                raise EOFError("{} bytes missing at the end of the file".format(
+                    self.count - nread))
+            pieces.append(data)
+            nread += len(data)
+        return b''.join(pieces)
+
+    def __repr__(self) -> str:
+        return '<{self.__class__.__name__} {self.fileobj!r} offset={self.offset} ' \
+            'count={self.count}>'.format(self=self)
+
+
+def _slice(segment: bytes, start: int, end: int) -> bytes:
+    if start == 0 and end == len(segment):
+        return segment
+    if type(segment) is FileSegment:
+        return segment[start:end]
+    return memoryview(segment)[start:end]
+
+
+def _join(pieces: typing.List[bytes]) -> bytes:
+    if len(pieces) == 1 and type(pieces[0]) is bytes:
+        return pieces[0]
+    try:
+        return b''.join(pieces)
+    except TypeError:  # File segments have to be read
+        return b''.join(_materialize(piece) for piece in pieces)
+
+
+def _view(pieces: typing.List[bytes]) -> memoryview:
+    if len(pieces) == 1 and type(pieces[0]) is not FileSegment:
+        return memoryview(pieces[0])
+    return memoryview(_join(pieces))
+
+
+def _materialize(segment: bytes) -> bytes:
+    if type(segment) is FileSegment:
+        return bytes(segment)
+    return segment
+
+
+class _NoResultType:
+    pass
+
+
+class _StateEndedType:
+    pass
+
+
+_no_result = _NoResultType()
+_state_ended = _StateEndedType()
+
+
+class _ReleasedBuffer(Buffer):
+    """Stands for the buffers given back to their pool, shared by all the consumers.
+
+    Writing to it would leak data into the other consumers, so it stays empty.
+    """
+
+    def write(self, chunk: bytes) -> None:
+        raise RuntimeError("The buffer was given back to its pool")
+
+
+_released_buffer = _ReleasedBuffer()
+
+
+class NoResult(RuntimeError):
+    """Raised when no result is available."""
+
+
+class LimitExceeded(RuntimeError):
+    """Raised when a size limit is exceeded."""
+
+
+class Timeout(RuntimeError):
+    """Raised in the protocol when the deadline of :func:`~ohneio.with_deadline` passed."""
+
+
+class _Action:
+    """Action yielded to the consumer.
+
+    Actions yielded to the consumer could be `object()`, but this custom object
+    with a custom `repr()` ease debugging.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __repr__(self) -> str:
+        return '<Action: {!r}>'.format(self.name)
+
+
+class _Wakeup(_Action):
+    """Action only resumed once a condition on the consumer is met.
+
+    This spares resuming the protocol generator when it couldn't progress anyway.
+    """
+
+    def __init__(self, name: str, predicate: typing.Callable[['Consumer'], bool]) -> None:
+        super().__init__(name)
+        self.predicate = predicate
+
+    def __repr__(self) -> str:
+        return '<Action: wait until {}>'.format(self.name)
+
+
+class _Sleep(_Wakeup):
+    """Action resumed once a deadline passed, or once an optional condition is met.
+
+    The deadline is reported to the driver by :meth:`Consumer.next_deadline`.
+    """
+
+    def __init__(self, name: str, deadline: float,
+                 predicate: typing.Optional[typing.Callable[['Consumer'], bool]]=None) -> None:
+        def ready(consumer: 'Consumer') -> bool:
+            if consumer._time() >= deadline:
+                return True
+            return predicate is not None and predicate(consumer)
+
+        super().__init__(name, ready)
+        self.deadline = deadline
+
+
+class _Offload(_Action):
+    """Action suspending the protocol until a function is run by the driver."""
+
+    def __init__(self, job: typing.Callable[[], typing.Any]) -> None:
+        super().__init__('offload')
+        self.job = job
+        self.polled = False
+
+
+class _OffloadFailure:
+    def __init__(self, exc: BaseException) -> None:
+        self.exc = exc
+
+
+_get_input = _Action('get_input')
+_get_output = _Action('get_output')
+_get_output_limit = _Action('get_output_limit')
+_get_messages = _Action('get_messages')
+_get_clock = _Action('get_clock')
+_wait = _Action('wait')
+
+
+T = typing.TypeVar('T')
+
+
+class ProtocolGenerator(typing.Generator[_Action, typing.Union[None, Buffer], T],
+                        typing.Generic[T]):
+    pass
+
+
+S = typing.TypeVar('S')
+
+
+class Stats:
+    """Counters collected by a :class:`~ohneio.Consumer` created with ``stats=True``.
+
+    Attributes:
+        resumptions (int): amount of times the protocol generator was resumed.
+        idle_wakeups (int): amount of times the protocol was woken up, and went back to waiting
+            without consuming input nor producing output.
+        bytes_in (int): amount of bytes sent to the protocol.
+        bytes_out (int): amount of bytes read from the protocol.
+        peak_input_length (int): maximum amount of bytes in the input buffer.
+        peak_input_segments (int): maximum amount of segments in the input buffer.
+        peak_output_length (int): maximum amount of bytes in the output buffer.
+        peak_output_segments (int): maximum amount of segments in the output buffer.
+        generator_time (float): total time spent inside the protocol generator, in seconds.
+    """
+    __slots__ = ('resumptions', 'idle_wakeups', 'bytes_in', 'bytes_out', 'peak_input_length',
+                 'peak_input_segments', 'peak_output_length', 'peak_output_segments',
+                 'generator_time')
+
+    def __init__(self) -> None:
+        self.resumptions = 0
+        self.idle_wakeups = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_input_length = 0
+        self.peak_input_segments = 0
+        self.peak_output_length = 0
+        self.peak_output_segments = 0
+        self.generator_time = 0.0
+
+    def as_dict(self) -> typing.Dict[str, typing.Union[int, float]]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return '<{} {}>'.format(self.__class__.__name__, ' '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+_INPUT_OVERFLOW_POLICIES = ('raise', 'close', 'partial')
+
+
+class Consumer(typing.Generic[S]):
+    """Protocol consumer
+
+    Allows the developer to send, read and get the result of protocol function.
+
+    This never needs to be instantiated, since this internally done by the :func:`~ohneio.protocol`
+    decorator.
+
+    Args:
+        gen: protocol generator.
+        output_high_water (:obj:`int`, optional): :func:`~ohneio.write` suspends the protocol
+            when more than ``output_high_water`` bytes of output are pending.
+        output_low_water (:obj:`int`, optional): once suspended, the protocol is resumed when
+            ``output_low_water`` bytes or less of output are pending. Defaults to a quarter of
+            ``output_high_water``.
+        max_input_buffer (:obj:`int`, optional): maximum amount of input bytes buffered. ``0``
+            means no limit.
+        input_high_water (:obj:`int`, optional): :attr:`reading_paused` becomes true once
+            ``input_high_water`` bytes of input or more are buffered. Defaults to
+            ``max_input_buffer``, ``0`` means never pausing.
+        input_low_water (:obj:`int`, optional): :attr:`reading_paused` becomes false again
+            when ``input_low_water`` bytes or less of input are buffered. Defaults to a quarter of
+            ``input_high_water``.
+        on_input_overflow (:obj:`str`, optional): what :meth:`send` does with data going over
+            ``max_input_buffer``. ``'raise'`` raises :exc:`~ohneio.LimitExceeded` without
+            accepting any data, ``'close'`` closes the consumer, and ``'partial'`` accepts the
+            data up to the limit.
+        stats (:obj:`bool`, optional): whether to collect :class:`~ohneio.Stats` in
+            :attr:`stats`.
+        on_action (:obj:`callable`, optional): called with the name of the action and the time
+            spent in the protocol generator (in seconds), every time the generator is resumed.
+            This implies ``stats=True``.
+        buffer_factory (:obj:`callable`, optional): called without arguments to create the input
+            and output buffers, for example :class:`~ohneio.CompactBuffer`. Defaults to the
+            ``buffer_factory`` class attribute, which is :class:`~ohneio.Buffer`.
+        pool (:obj:`BufferPool`, optional): pool to take the input and output buffers from,
+            instead of calling ``buffer_factory``. The buffers are given back to the pool once the
+            protocol ended (the output once it was entirely read), or once the consumer is
+            closed. Data sent afterwards is ignored.
+        checked (:obj:`bool`, optional): whether to check every value yielded by the protocol.
+            With ``checked=False``, only the first one is checked, and the protocol is driven by a
+            faster loop, which doesn't go through :meth:`_next_state`. This has no effect when
+            collecting stats.
+        max_messages (:obj:`int`, optional): :func:`~ohneio.emit` suspends the protocol once
+            ``max_messages`` messages are waiting to be polled. ``0`` means no limit.
+        clock (:obj:`callable`, optional): called without arguments to get the current time, in
+            seconds, for :func:`~ohneio.sleep` and :func:`~ohneio.with_deadline`. Defaults to
+            :func:`time.monotonic`.
+    """
+    buffer_factory = Buffer  # type: typing.Callable[[], typing.Any]
+
+    def __init__(self, gen: ProtocolGenerator[S], *, output_high_water: int=0,
+                 output_low_water: typing.Optional[int]=None, max_input_buffer: int=0,
+                 input_high_water: typing.Optional[int]=None,
+                 input_low_water: typing.Optional[int]=None,
+                 on_input_overflow: str='raise', stats: bool=False,
+                 on_action: typing.Optional[typing.Callable[[str, float], None]]=None,
+                 buffer_factory: typing.Optional[typing.Callable[[], typing.Any]]=None,
+                 pool: typing.Optional[BufferPool]=None, checked: bool=True,
+                 max_messages: int=0,
+                 clock: typing.Callable[[], float]=time.monotonic,
+                 _input: typing.Optional[Buffer]=None) -> None:
+        if output_low_water is None:
+            output_low_water = output_high_water // 4
+        if not 0 <= output_low_water <= output_high_water:
+            raise ValueError("Output watermarks must verify 0 <= low <= high")
+        if input_high_water is None:
+            input_high_water = max_input_buffer
+        if input_low_water is None:
+            input_low_water = input_high_water // 4
+        if not (0 <= input_low_water < input_high_water or
+                input_low_water == input_high_water == 0):
+            raise ValueError("Input watermarks must verify 0 <= low < high")
+        if on_input_overflow not in _INPUT_OVERFLOW_POLICIES:
+            raise ValueError("on_input_overflow must be one of {}".format(
+                ', '.join(_INPUT_OVERFLOW_POLICIES)))
+
+        if pool is not None:
+            buffer_factory = pool.acquire
+        elif buffer_factory is None:
+            buffer_factory = self.buffer_factory
+        self.pool = pool
+        self.gen = gen
+        self.input = buffer_factory() if _input is None else _input
+        self.output = buffer_factory()
+        self.output_high_water = output_high_water
+        self.output_low_water = output_low_water
+        self._output_paused = False
+        self.max_input_buffer = max_input_buffer
+        self.input_high_water = input_high_water
+        self.input_low_water = input_low_water
+        self.on_input_overflow = on_input_overflow
+        self._reading_paused = False
+        self._messages = collections.deque()  # type: collections.deque[typing.Any]
+        self.max_messages = max_messages
+        self.clock = clock
+        self._now = None  # type: typing.Optional[float]
+        self.on_action = on_action
+        self.stats = None  # type: typing.Optional[Stats]
+        if stats or on_action is not None:
+            self.stats = Stats()
+            self._wakeup_snapshot = None  # type: typing.Optional[typing.Tuple[int, int]]
+            self._next_state = self._next_state_instrumented  # type: ignore
+        elif not checked:
+            self._process = self._process_unchecked  # type: ignore
+        self.state = next(gen)  # type: typing.Union[_Action, _StateEndedType]
+        if not isinstance(self.state, _Action):  # pragma: no cover
+            # This is just a hint for users misusing the library.
+            raise RuntimeError("Can't yield anything else than an action. Using `yield` instead "
+                               "`yield from`?")
+        self.res = _no_result  # type: typing.Union[S, _NoResultType]
+
+    @classmethod
+    def from_mmap(cls, gen: ProtocolGenerator[S], path: str,
+                  **options: typing.Any) -> 'Consumer[S]':
+        """Create a consumer whose input is a memory-mapped file.
+
+        The input is a :class:`~ohneio.MmapBuffer`, so the protocol reads :class:`memoryview`
+        objects on the mapping instead of bytes. This is also available as ``from_mmap(path,
+        *args, **kwargs)`` on the functions decorated with :func:`~ohneio.protocol`.
+
+        Protocols can be used both live and on files, as long as they don't rely on methods of
+        :class:`bytes` missing from :class:`memoryview`, like ``find()``, on the data returned by
+        :func:`~ohneio.peek` and :func:`~ohneio.read`. The mapping is closed once the protocol
+        ended or the consumer is closed, unless views on it are still used.
+
+        Args:
+            gen: protocol generator.
+            path (str): path of the file to parse.
+            **options: see :class:`~ohneio.Consumer`.
+
+        Returns:
+            Consumer: consumer, which already processed the file.
+
+        Example:
+
+            >>> import tempfile
+            >>> @protocol
+            ... def count_lines():
+            ...     lines = 0
+            ...     while (yield from readline()) != b'end\\n':
+            ...         lines += 1
+            ...     return lines
+            ...
+            >>> with tempfile.NamedTemporaryFile() as fp:
+            ...     _ = fp.write(b'foo\\nbar\\nend\\n')
+            ...     fp.flush()
+            ...     count_lines.from_mmap(fp.name).get_result()
+            2
+        """
+        consumer = cls(gen, _input=MmapBuffer(path), **options)
+        if consumer.stats is not None:
+            consumer.stats.bytes_in += len(consumer.input)
+            consumer._update_peaks(consumer.stats)
+        consumer._process()
+        return consumer
+
+    def _process(self) -> None:
+        if self.state is _state_ended:
+            self._release_buffers()
+            return
+
+        while self.state is _wait:
+            self._next_state()
+        while True:
+            state = self.state
+            if state is _get_output:
+                self._next_state(self.output)
+            elif state is _get_input:
+                self._next_state(self.input)
+            elif state is _get_output_limit:
+                self._next_state((self.output, self.output_high_water))
+            elif state is _get_messages:
+                self._next_state((self._messages, self.max_messages))
+            elif state is _get_clock:
+                self._next_state(self._time)
+            elif isinstance(state, _Wakeup) and state.predicate(self):
+                self._next_state()
+            else:
+                break
+        if self.state is _state_ended:
+            self._release_buffers()
+
+    def _process_unchecked(self) -> None:
+        """Like :meth:`_process`, without checking the actions yielded by the protocol."""
+        state = self.state
+        if state is _state_ended:
+            self._release_buffers()
+            return
+
+        send = self.gen.send
+        get_input, get_output = _get_input, _get_output
+        try:
+            while state is _wait:
+                state = self.state = send(None)
+            while True:
+                if state is get_input:
+                    state = self.state = send(self.input)
+                elif state is get_output:
+                    state = self.state = send(self.output)
+                elif state is _get_output_limit:
+                    state = self.state = send((self.output, self.output_high_water))
+                elif state is _get_messages:
+                    state = self.state = send((self._messages, self.max_messages))
+                elif state is _get_clock:
+                    state = self.state = send(self._time)
+                elif isinstance(state, _Wakeup) and state.predicate(self):
+                    state = self.state = send(None)
+                else:
+                    break
+        except StopIteration as e:
+            self.state = _state_ended
+            if len(e.args) > 0:
+                self.res = e.args[0]
+            self._release_buffers()
+
+    def _time(self) -> float:
+        return self._now if self._now is not None else self.clock()
+
+    def _release_buffers(self) -> None:
+        """Give the buffers back to the pool, once the protocol can't use them anymore."""
+        input_ = self.input
+        if isinstance(input_, MmapBuffer):
+            # A memory-mapped input wasn't taken from the pool
+            if input_.mmap is not None:
+                try:
+                    input_.close()
+                except BufferError:
+                    pass  # Views on the mapping are still used, leave it to the garbage collector
+        elif self.pool is not None and input_ is not _released_buffer:
+            self.pool.release(input_)
+            self.input = _released_buffer
+        if self.pool is not None and self.output is not _released_buffer and len(self.output) == 0:
+            self.pool.release(self.output)
+            self.output = _released_buffer
+
+    def _next_state(self, value: typing.Any=None) -> None:
+        try:
+            self.state = self.gen.send(value)
+            if not isinstance(self.state, _Action):  # pragma: no cover
+                # This is just a hint for users misusing the library.
+                raise RuntimeError("Can't yield anything else than an action. Using `yield` "
+                                   "instead `yield from`?")
+        except StopIteration as e:
+            self.state = _state_ended
+            if len(e.args) > 0:
+                self.res = e.args[0]
+
+    def _next_state_instrumented(self, value: typing.Any=None) -> None:
+        stats = self.stats
+        assert stats is not None
+        action = self.state
+        assert isinstance(action, _Action)
+        if action is _wait or isinstance(action, _Wakeup):
+            self._wakeup_snapshot = (len(self.input), len(self.output))
+
+        start = time.perf_counter()
+        type(self)._next_state(self, value)
+        elapsed = time.perf_counter() - start
+
+        stats.resumptions += 1
+        stats.generator_time += elapsed
+        if self._wakeup_snapshot is not None and (self.state is _wait or
+                                                  isinstance(self.state, _Wakeup)):
+            if self._wakeup_snapshot == (len(self.input), len(self.output)):
+                stats.idle_wakeups += 1
+            self._wakeup_snapshot = None
+        self._update_peaks(stats)
+        if self.on_action is not None:
+            self.on_action(action.name, elapsed)
+
+    def _update_peaks(self, stats: Stats) -> None:
+        stats.peak_input_length = max(stats.peak_input_length, len(self.input))
+        stats.peak_input_segments = max(stats.peak_input_segments, self.input.segment_count)
+        stats.peak_output_length = max(stats.peak_output_length, len(self.output))
+        stats.peak_output_segments = max(stats.peak_output_segments, self.output.segment_count)
+
+    def poll_offload(self) -> typing.Optional[typing.Callable[[], typing.Any]]:
+        """Get the function the protocol is waiting for, if any.
+
+        When the protocol uses :func:`~ohneio.offload`, the driver has to run the function
+        returned here, for example in a :class:`concurrent.futures.Executor`, and report its
+        outcome with :meth:`set_offload_result` or :meth:`set_offload_exception`.
+
+        Each function is only returned once.
+
+        Returns:
+            callable: function to call without arguments, or ``None``.
+        """
+        self._process()
+        state = self.state
+        if not isinstance(state, _Offload) or state.polled:
+            return None
+        state.polled = True
+        return state.job
+
+    def set_offload_result(self, result: typing.Any) -> None:
+        """Resume the protocol with the result of the offloaded function."""
+        if not isinstance(self.state, _Offload):
+            raise RuntimeError("The protocol isn't waiting for an offloaded function")
+        self._next_state(result)
+        self._process()
+
+    def set_offload_exception(self, exc: BaseException) -> None:
+        """Resume the protocol by raising the exception of the offloaded function."""
+        self.set_offload_result(_OffloadFailure(exc))
+
+    def poll_messages(self, max_n: int=0) -> typing.List[typing.Any]:
+        """Get the messages emitted by the protocol with :func:`~ohneio.emit`.
+
+        Args:
+            max_n (:obj:`int`, optional): amount of messages to get *at most*. ``0`` means all
+                the messages available.
+
+        Returns:
+            list: messages, in the order they were emitted.
+        """
+        self._process()
+        messages = self._messages
+        if max_n == 0 or max_n >= len(messages):
+            polled = list(messages)
+            messages.clear()
+        else:
+            polled = [messages.popleft() for i in range(max_n)]
+        if polled:
+            self._process()  # Resume the protocol if it waited for room in the queue
+        return polled
+
+    def next_deadline(self) -> typing.Optional[float]:
+        """Get the time at which the protocol has to be woken up with :meth:`tick`.
+
+        This is set while the protocol waits in :func:`~ohneio.sleep` or
+        :func:`~ohneio.with_deadline`. Drivers handling many consumers can keep their deadlines
+        in a single timer heap.
+
+        Returns:
+            float: deadline, according to the ``clock`` of the consumer, or ``None``.
+        """
+        self._process()
+        state = self.state
+        if isinstance(state, _Sleep):
+            return state.deadline
+        return None
+
+    def tick(self, now: typing.Optional[float]=None) -> typing.Optional[float]:
+        """Wake up the protocol if its deadline passed.
+
+        Args:
+            now (:obj:`float`, optional): current time. Defaults to calling the ``clock`` of the
+                consumer.
+
+        Returns:
+            float: the next deadline, see :meth:`next_deadline`.
+
+        Raises:
+            Timeout: When the deadline of :func:`~ohneio.with_deadline` passed, and the protocol
+                didn't handle it.
+
+        Example:
+
+            >>> @protocol(clock=lambda: 0.0)
+            ... def keepalive():
+            ...     while True:
+            ...         yield from sleep(30)
+            ...         yield from write_nowait(b'PING\\n')
+            ...
+            >>> conn = keepalive()
+            >>> conn.next_deadline()
+            30.0
+            >>> conn.tick(29.5)
+            30.0
+            >>> conn.read()
+            b''
+            >>> conn.tick(30.0)
+            60.0
+            >>> conn.read()
+            b'PING\\n'
+        """
+        self._now = now
+        try:
+            self._process()
+        finally:
+            self._now = None
+        return self.next_deadline()
+
+    def messages(self) -> typing.Iterator[typing.Any]:
+        """Iterate over the messages emitted by the protocol, until none is available.
+
+        Example:
+
+            >>> @protocol
+            ... def lines():
+            ...     while True:
+            ...         line = yield from readline()
+            ...         yield from emit(line.rstrip())
+            ...
+            >>> conn = lines()
+            >>> conn.send(b'foo\\nbar\\nba')
+            >>> list(conn.messages())
+            [b'foo', b'bar']
+        """
+        while True:
+            polled = self.poll_messages()
+            if not polled:
+                return
+            yield from polled
+
+    @property
+    def is_paused(self) -> bool:
+        """bool: Whether the protocol is paused because too much output is pending
+
+        The protocol gets paused when the output goes above the high watermark, and stays paused
+        until it goes back to the low watermark.
+        """
+        pending = len(self.output)
+        if self._output_paused:
+            if pending <= self.output_low_water:
+                self._output_paused = False
+        elif pending > self.output_high_water:
+            self._output_paused = True
+        return self._output_paused
+
+    @property
+    def reading_paused(self) -> bool:
+        """bool: Whether the transport should stop reading, because too much input is buffered
+
+        Reading gets paused when the input reaches the input high watermark, and stays paused
+        until it goes back to the input low watermark.
+        """
+        if self.input_high_water == 0:
+            return False
+        buffered = len(self.input)
+        if self._reading_paused:
+            if buffered <= self.input_low_water:
+                self._reading_paused = False
+        elif buffered >= self.input_high_water:
+            self._reading_paused = True
+        return self._reading_paused
+
+    @property
+    def input_capacity(self) -> typing.Optional[int]:
+        """int: Amount of bytes :meth:`send` can still accept, ``None`` when unlimited"""
+        if self.max_input_buffer == 0:
+            return None
+        return max(self.max_input_buffer - len(self.input), 0)
+
+    @property
+    def closed(self) -> bool:
+        """bool: Whether the protocol ended or the consumer was closed"""
+        return self.state is _state_ended
+
+    def close(self) -> None:
+        """Close the protocol.
+
+        The protocol generator is closed, and won't be resumed anymore.
+        """
+        if self.state is not _state_ended:
+            self.gen.close()
+            self.state = _state_ended
+        self._release_buffers()
+
+    @property
+    def writable(self) -> bool:
+        """bool: Whether output is pending, and should be written to the transport"""
+        self._process()
+        return len(self.output) > 0
+
+    @property
+    def has_result(self) -> bool:
+        """bool: Whether a result is available or not"""
+        return self.res is not _no_result
+
+    def get_result(self) -> S:
+        """Get the result from the protocol
+
+        Returns:
+            The object returned by the protocol.
+
+        Raises:
+            NoResult: When no result is available
+        """
+        self._process()
+        if not self.has_result:
+            raise NoResult
+        assert not isinstance(self.res, _NoResultType)
+        return self.res
+
+    def read(self, nbytes: int=0) -> bytes:
+        """Read bytes from the output of the protocol.
+
+        Args:
+            nbytes: Read *at most* ``nbytes``, less bytes can be returned. If ``nbytes=0``
+                then all available bytes are read.
+
+        Returns:
+            bytes: bytes read
+        """
+        pieces = []
+        nread = 0
+        while True:
+            data = self.output.read(0 if nbytes == 0 else nbytes - nread)
+            pieces.append(data)
+            nread += len(data)
+
+            if nbytes > 0 and nread == nbytes:
+                break
+
+            self._process()
+
+            if len(self.output) == 0:
+                break
+        if self.stats is not None:
+            self.stats.bytes_out += nread
+        return b''.join(pieces)
+
+    def readinto(self, buffer: typing.Union[bytearray, memoryview]) -> int:
+        """Read bytes from the output of the protocol directly into a writable buffer.
+
+        Args:
+            buffer: pre-allocated buffer, filled with *at most* ``len(buffer)`` bytes.
+
+        Returns:
+            int: amount of bytes written into ``buffer``
+        """
+        view = memoryview(buffer)
+        nread = 0
+        while True:
+            nread += self.output.readinto(view[nread:])
+
+            if nread == len(view):
+                break
+
+            self._process()
+
+            if len(self.output) == 0:
+                break
+        if self.stats is not None:
+            self.stats.bytes_out += nread
+        return nread
+
+    def read_segments(self, max_bytes: int=0) -> typing.List[bytes]:
+        """Get the output of the protocol as a list of segments, without consuming it.
+
+        The segments are not joined together, which allows them to be passed as is to
+        :func:`socket.socket.sendmsg` or :func:`os.writev`. Once (some of) the data has been
+        sent, it has to be consumed with :meth:`~ohneio.Consumer.consume`.
+
+        Ranges of files written with :func:`~ohneio.write_file` are
+        :class:`~ohneio.FileSegment` objects, which are not bytes-like: they have to be sent with
+        :func:`os.sendfile`, or converted with :func:`bytes`.
+
+        Args:
+            max_bytes (:obj:`int`, optional): amount of bytes covered by the segments *at most*.
+                ``0`` means all the available output.
+
+        Returns:
+            list: bytes-like objects, and :class:`~ohneio.FileSegment` objects.
+        """
+        self._process()
+        return self.output.segments(max_bytes)
+
+    def consume(self, nbytes: int) -> None:
+        """Consume bytes from the output of the protocol.
+
+        Args:
+            nbytes (int): amount of bytes which were actually sent.
+
+        Returns:
+            None
+        """
+        self.output.consume(nbytes)
+        if self.stats is not None:
+            self.stats.bytes_out += nbytes
+        self._process()
+
+    def send(self, data: bytes) -> None:
+        """Send data to the input of the protocol
+
+        When the consumer has a ``max_input_buffer``, only :attr:`input_capacity` bytes can be
+        sent. What happens to the data above this limit depends on ``on_input_overflow``.
+
+        Args:
+            bytes: data to send to the protocol
+
+        Returns:
+            None
+
+        Raises:
+            LimitExceeded: When the input buffer limit is reached, and the consumer is configured
+                to raise.
+        """
+        if self._accept(data):
+            self._process()
+
+    def send_many(self, chunks: typing.Iterable[bytes]) -> None:
+        """Send several chunks of data to the input of the protocol at once
+
+        The chunks are all appended to the input before resuming the protocol, which is cheaper
+        than calling :meth:`send` for each of them. Like :meth:`send`, no data is accepted when
+        the chunks go over the input buffer limit, and the consumer is configured to raise.
+
+        Args:
+            chunks: iterable of bytes-like objects.
+
+        Returns:
+            None
+
+        Raises:
+            LimitExceeded: See :meth:`send`.
+        """
+        capacity = self.input_capacity
+        if capacity is not None and self.on_input_overflow == 'raise':
+            chunks = list(chunks)
+            if sum(len(chunk) for chunk in chunks) > capacity:
+                raise LimitExceeded("Input buffer limit of {} bytes reached".format(
+                    self.max_input_buffer))
+        for chunk in chunks:
+            if not self._accept(chunk):
+                return
+        self._process()
+
+    def feed_stream(self, fileobj: typing.BinaryIO, chunk_size: int=65536) -> int:
+        """Send the content of a binary file to the input of the protocol
+
+        The file is read by chunks of ``chunk_size`` bytes, until its end, until the protocol
+        ends, or until the input buffer is full. When the file supports ``readinto()``, the chunks
+        are read into a buffer reused as long as the protocol consumed all its input.
+
+        The input buffer can only be full with a ``max_input_buffer``, when the protocol waits
+        for something else than input, like its output to be read. :attr:`input_capacity` is
+        then ``0``, and feeding can be resumed by calling this again once the protocol
+        progressed. At the end of the file, it is still positive, unless the protocol ended.
+
+        Args:
+            fileobj: binary file object.
+            chunk_size (:obj:`int`, optional): amount of bytes read at most at once.
+
+        Returns:
+            int: amount of bytes sent.
+
+        Raises:
+            LimitExceeded: See :meth:`send`.
+        """
+        readinto = getattr(fileobj, 'readinto', None)
+        buffer = None  # type: typing.Optional[bytearray]
+        total = 0
+        while not self.closed:
+            capacity = self.input_capacity
+            size = chunk_size if capacity is None else min(chunk_size, capacity)
+            if size == 0:
+                break
+
+            if readinto is None:
+                chunk = fileobj.read(size)  # type: typing.Union[bytes, bytearray, memoryview]
+                nbytes = len(chunk)
+            else:
+                if buffer is None or len(buffer) != size or not _is_reusable(buffer, self.input):
+                    buffer = bytearray(size)
+                nbytes = readinto(buffer) or 0
+                chunk = buffer if nbytes == size else memoryview(buffer)[:nbytes]
+
+            if nbytes == 0:
+                break
+            self.send(chunk)
+            total += nbytes
+            del chunk
+        return total
+
+    def _accept(self, data: bytes) -> bool:
+        """Append data to the input, according to the input buffer limit.
+
+        Returns:
+            bool: ``False`` when the consumer got closed, or gave its buffers back to the pool.
+        """
+        if self.input is _released_buffer:
+            return False
+        capacity = self.input_capacity
+        if capacity is not None and len(data) > capacity:
+            if self.on_input_overflow == 'raise':
+                raise LimitExceeded("Input buffer limit of {} bytes reached".format(
+                    self.max_input_buffer))
+            elif self.on_input_overflow == 'close':
+                self.close()
+                return False
+            data = memoryview(data)[:capacity]
+        self.input.write(data)
+        if self.stats is not None:
+            self.stats.bytes_in += len(data)
+            self._update_peaks(self.stats)
+        return True
+
+
+def _is_reusable(buffer: bytearray, input_: Buffer) -> bool:
+    """Whether a buffer sent to the protocol can be overwritten.
+
+    This is the case when the protocol consumed all its input, and didn't keep any view on the
+    buffer. (A bytearray can't be resized while views on it exist.)
+    """
+    if len(input_) != 0:
+        return False
+    try:
+        buffer.append(0)
+    except BufferError:
+        return False
+    del buffer[-1]
+    return True
+
+
+class Pipeline:
+    """Chain of consumers, the output of each one being the input of the next one.
+
+    The segments of the output of a consumer are moved to the input of the next one, without
+    being joined nor copied. Data is only moved as long as the next consumer has
+    :attr:`~Consumer.input_capacity` left, otherwise it stays in the output of the previous
+    consumer, whose protocol gets paused by its output watermarks.
+
+    This never needs to be instantiated, see :func:`~ohneio.pipeline`.
+
+    Attributes:
+        consumers (list): consumers of the pipeline, in order.
+    """
+
+    def __init__(self, consumers: typing.Sequence[Consumer]) -> None:
+        if len(consumers) == 0:
+            raise ValueError("A pipeline needs at least one consumer")
+        self.consumers = list(consumers)
+
+    def _flow(self) -> None:
+        moved = True
+        while moved:
+            moved = False
+            for upstream, downstream in zip(self.consumers, self.consumers[1:]):
+                if _move(upstream, downstream) > 0:
+                    moved = True
+
+    def send(self, data: bytes) -> None:
+        """Send data to the input of the first consumer."""
+        self.consumers[0].send(data)
+        self._flow()
+
+    def send_many(self, chunks: typing.Iterable[bytes]) -> None:
+        """Send several chunks of data to the input of the first consumer."""
+        self.consumers[0].send_many(chunks)
+        self._flow()
+
+    def read(self, nbytes: int=0) -> bytes:
+        """Read bytes from the output of the last consumer, see :meth:`Consumer.read`."""
+        last = self.consumers[-1]
+        pieces = []
+        nread = 0
+        while nbytes == 0 or nread < nbytes:
+            self._flow()
+            data = last.read(0 if nbytes == 0 else nbytes - nread)
+            if not data:
+                break
+            pieces.append(data)
+            nread += len(data)
+        return b''.join(pieces)
+
+    @property
+    def has_result(self) -> bool:
+        """bool: Whether the result of the last consumer is available"""
+        return self.consumers[-1].has_result
+
+    def get_result(self) -> typing.Any:
+        """Get the result of the last consumer, see :meth:`Consumer.get_result`."""
+        self._flow()
+        return self.consumers[-1].get_result()
+
+    @property
+    def closed(self) -> bool:
+        """bool: Whether the last consumer is closed"""
+        return self.consumers[-1].closed
+
+    def close(self) -> None:
+        """Close all the consumers."""
+        for consumer in self.consumers:
+            consumer.close()
+
+
+def _move(upstream: Consumer, downstream: Consumer) -> int:
+    """Move the output of ``upstream`` to the input of ``downstream``.
+
+    Returns:
+        int: amount of bytes moved.
+    """
+    capacity = downstream.input_capacity
+    if capacity == 0 or downstream.closed:
+        return 0
+    segments = upstream.read_segments(capacity or 0)
+    if not segments:
+        return 0
+    nbytes = sum(len(segment) for segment in segments)
+    # Protocols parse their input in place, file segments have to be read
+    downstream.send_many([_materialize(segment) for segment in segments])
+    upstream.consume(nbytes)
+    return nbytes
+
+
+def pipeline(*consumers: Consumer) -> Pipeline:
+    """Chain consumers, the output of each one being the input of the next one.
+
+    This allows to stack protocols, like a framing protocol and an application protocol. The data
+    is moved from a consumer to the next one without being copied, it is only joined when the
+    output of the last consumer is read.
+
+    Args:
+        *consumers: consumers to chain, the first one receives the data sent to the pipeline.
+
+    Returns:
+        Pipeline: object with the :meth:`~Pipeline.send`, :meth:`~Pipeline.read` and
+        :meth:`~Pipeline.get_result` methods of a consumer.
+
+    Example:
+
+        >>> @protocol
+        ... def deframe():
+        ...     while True:
+        ...         _, body = yield from read_frame(struct.Struct('!B'))
+        ...         yield from write(body)
+        ...
+        >>> @protocol
+        ... def shout():
+        ...     line = yield from readline()
+        ...     yield from write(line.upper())
+        ...     return len(line)
+        ...
+        >>> stack = pipeline(deframe(), shout())
+        >>> stack.send(b'\\x03foo\\x04')
+        >>> stack.read()
+        b''
+        >>> stack.send(b' bar\\x01\\n')
+        >>> stack.read()
+        b'FOO BAR\\n'
+        >>> stack.get_result()
+        8
+    """
+    return Pipeline(consumers)
+
+
+def peek(nbytes=0) -> typing.Generator[_Action, Buffer, bytes]:
+    """Read output without consuming it.
+
+    Read but **does not** consume data from the protocol input. With
+    :meth:`Consumer.from_mmap`, this returns a :class:`memoryview` instead of bytes.
+
+    This is a *non-blocking* primitive, if less data than requested is available,
+    less data is returned. It is meant to be used in combination with :func:`~ohneio.wait`, but
+    edge cases and smart people can (and most likely will) prove me wrong.
+
+    Args:
+        nbytes (:obj:`int`, optional): amount of bytes to read *at most*. ``0`` meaning all bytes.
+
+    Returns:
+        bytes: data read from the buffer
+    """
+    input_ = yield _get_input
+    return input_.peek(nbytes)
+
+
+def wait() -> typing.Generator[_Action, None, None]:
+    """Wait for any action to be triggered on the consumer.
+
+    This waits for any action to be triggered on the consumer, in most cases, this means more
+    input is available or some output has been consumed. *But, it could also mean that the result
+    of the protocol has been polled.* Therefore, it is always considered a good practice to wait
+    at the end of a loop, and execute your non-blocking primitive before.
+
+    Returns:
+        None
+
+    Example:
+        >>> def wait_for(b):
+        ...   while True:
+        ...     data = yield from peek()
+        ...     pos = data.find(b)
+        ...     if pos >= 0:
+        ...       return pos
+        ...     yield from wait()
+        ...
+        >>> @protocol
+        ... def linereader():
+        ...   pos = yield from wait_for(b'\\n')
+        ...   data = yield from read(pos)
+        ...   return data.decode('ascii')
+        ...
+        >>> conn = linereader()
+        >>> conn.send(b"Hello ")
+        >>> conn.has_result
+        False
+        >>> conn.read()
+        b''
+        >>> conn.send(b"World\\nRight?")
+        >>> conn.get_result()
+        'Hello World'
+    """
+    yield _wait
+
+
+def _wait_until(name: str, predicate: typing.Callable[[Consumer], bool]
+                ) -> typing.Generator[_Action, None, None]:
+    """Wait for ``predicate(consumer)`` to be true.
+
+    Unlike :func:`~ohneio.wait`, the protocol is not resumed on every action triggered on the
+    consumer, only when the predicate is met.
+    """
+    yield _Wakeup(name, predicate)
+
+
+def sleep(seconds: float) -> typing.Generator[_Action, typing.Any, None]:
+    """Wait for some time.
+
+    The protocol is only woken up by :meth:`Consumer.tick`, once the deadline reported by
+    :meth:`Consumer.next_deadline` passed, according to the ``clock`` of the consumer.
+
+    Args:
+        seconds (float): time to wait, in seconds.
+
+    Returns:
+        None
+
+    Example:
+
+        >>> now = 10.0
+        >>> @protocol(clock=lambda: now)
+        ... def delayed_echo():
+        ...     line = yield from readline()
+        ...     yield from sleep(0.5)
+        ...     yield from write(line)
+        ...
+        >>> conn = delayed_echo()
+        >>> conn.send(b'Hello\\n')
+        >>> conn.next_deadline()
+        10.5
+        >>> conn.read()
+        b''
+        >>> now = 11.0
+        >>> conn.tick()
+        >>> conn.read()
+        b'Hello\\n'
+    """
+    clock = yield _get_clock
+    yield _Sleep('{} seconds elapsed'.format(seconds), clock() + seconds)
+
+
+def with_deadline(seconds: float, gen: typing.Generator[_Action, typing.Any, T]
+                  ) -> typing.Generator[_Action, typing.Any, T]:
+    """Run a protocol generator, raising :exc:`~ohneio.Timeout` in it if it takes too long.
+
+    Whenever ``gen`` waits, the deadline is reported by :meth:`Consumer.next_deadline`, and
+    :meth:`Consumer.tick` raises :exc:`~ohneio.Timeout` inside ``gen`` once it passed. When
+    ``gen`` handles the exception, the deadline isn't enforced anymore. Inside ``gen``,
+    :func:`~ohneio.wait` is resumed once the input or the output of the consumer changed.
+
+    Args:
+        seconds (float): time ``gen`` has to return, in seconds.
+        gen: protocol generator, for example ``readline()``.
+
+    Returns:
+        The value returned by ``gen``.
+
+    Raises:
+        Timeout: When the deadline passed before ``gen`` returned.
+
+    Example:
+
+        >>> now = 0.0
+        >>> @protocol(clock=lambda: now)
+        ... def idle_timeout():
+        ...     while True:
+        ...         try:
+        ...             line = yield from with_deadline(60, readline())
+        ...         except Timeout:
+        ...             yield from write(b'Bye\\n')
+        ...             return 'timeout'
+        ...         yield from write(line)
+        ...
+        >>> conn = idle_timeout()
+        >>> conn.send(b'Hello\\n')
+        >>> conn.read()
+        b'Hello\\n'
+        >>> now = 30.0
+        >>> conn.send(b'Wor')
+        >>> conn.next_deadline()
+        60.0
+        >>> now = 60.0
+        >>> conn.tick()
+        >>> conn.read()
+        b'Bye\\n'
+        >>> conn.get_result()
+        'timeout'
+    """
+    clock = yield _get_clock
+    deadline = clock() + seconds  # type: typing.Optional[float]
+    value = None  # type: typing.Any
+    exc = None  # type: typing.Optional[Timeout]
+    while True:
+        try:
+            action = gen.send(value) if exc is None else gen.throw(exc)
+        except StopIteration as e:
+            return e.value
+        exc = None
+        if deadline is None or not (action is _wait or isinstance(action, _Wakeup)):
+            value = yield action
+            continue
+
+        if isinstance(action, _Sleep) and action.deadline <= deadline:
+            value = yield action
+            continue
+        if action is _wait:
+            input_ = yield _get_input
+            output = yield _get_output
+            lengths = (len(input_), len(output))
+
+            def changed(consumer: Consumer) -> bool:
+                return (len(consumer.input), len(consumer.output)) != lengths
+
+            name, predicate = 'input or output', changed
+        else:
+            name, predicate = action.name, action.predicate
+        value = yield _Sleep('{} before the deadline'.format(name), deadline, predicate)
+        if clock() >= deadline:
+            exc = Timeout("Deadline of {} seconds passed".format(seconds))
+            deadline = None
+
+
+def read(nbytes: int=0) -> typing.Generator[_Action, typing.Union[Buffer, None], bytes]:
+    """Read and consume data.
+
+    Read and consume data from the protocol input. And wait for it if an amount
+    of bytes is specified. With :meth:`Consumer.from_mmap`, this returns a :class:`memoryview`
+    instead of bytes.
+
+    Args:
+        nbytes (:obj:`int`, optional): amount of bytes to read. If ``nbytes=0``, it reads all
+            data available in the buffer, and does not block. Therefore, it means if no data
+            is available, it will return 0 bytes.
+
+    Returns:
+        bytes: data read from the buffer.
+
+    Example:
+
+        >>> @protocol
+        ... def reader():
+        ...    data = yield from read()
+        ...    print("Read:", repr(data))
+        ...    data = yield from read(3)
+        ...    print("Read:", repr(data))
+        ...
+        >>> conn = reader()
+        >>> conn.send(b'Hello')
+        Read: b'Hello'
+        >>> conn.send(b'fo')
+        >>> conn.send(b'obar')
+        Read: b'foo'
+    """
+    input_ = yield from _wait_for_input(nbytes)
+    return input_.read(nbytes)
+
+
+def read_chunk(remaining: int) -> typing.Generator[_Action, typing.Union[Buffer, None], bytes]:
+    """Read and consume the data available, up to ``remaining`` bytes.
+
+    Unlike :func:`~ohneio.read`, this doesn't wait for all the ``remaining`` bytes, only for at
+    least one byte. This allows to process a large body, of which the length is known, as it
+    comes, without buffering it entirely.
+
+    Args:
+        remaining (int): amount of bytes to read *at most*. ``0`` returns ``b''`` right away.
+
+    Returns:
+        bytes: between 1 and ``remaining`` bytes.
+
+    Example:
+
+        >>> import hashlib
+        >>> @protocol
+        ... def hasher(length):
+        ...     digest = hashlib.sha256()
+        ...     while length > 0:
+        ...         chunk = yield from read_chunk(length)
+        ...         print("Read:", repr(chunk))
+        ...         digest.update(chunk)
+        ...         length -= len(chunk)
+        ...     return digest.hexdigest()[:8]
+        ...
+        >>> conn = hasher(8)
+        >>> conn.send(b'Hello')
+        Read: b'Hello'
+        >>> conn.send(b' World')
+        Read: b' Wo'
+        >>> conn.get_result()
+        'ec5e8abc'
+    """
+    if remaining <= 0:
+        return b''
+    input_ = yield from _wait_for_input(1)
+    return input_.read(remaining)
+
+
+def _wait_for_input(nbytes: int) -> typing.Generator[_Action, typing.Union[Buffer, None], Buffer]:
+    input_ = yield _get_input
+    if len(input_) < nbytes:
+        yield from _wait_until('{} bytes of input'.format(nbytes),
+                               lambda consumer: len(consumer.input) >= nbytes)
+    return input_
+
+
+def read_struct(fmt: typing.Union[struct.Struct, str]
+                ) -> typing.Generator[_Action, typing.Union[Buffer, None], tuple]:
+    """Read and unpack a binary structure.
+
+    Wait for ``fmt.size`` bytes of input, and unpack them in one go. The structure is unpacked
+    directly from the buffered data when possible.
+
+    Args:
+        fmt (struct.Struct): structure to unpack. A format string is also accepted, but a
+            precompiled :class:`struct.Struct` avoids compiling it on every call.
+
+    Returns:
+        tuple: unpacked values.
+
+    Example:
+
+        >>> HEADER = struct.Struct('!BH')
+        >>> @protocol
+        ... def reader():
+        ...    data = yield from read_struct(HEADER)
+        ...    print("Read:", repr(data))
+        ...
+        >>> conn = reader()
+        >>> conn.send(b'\\x01\\x00')
+        >>> conn.send(b'\\x02')
+        Read: (1, 2)
+    """
+    if not isinstance(fmt, struct.Struct):
+        fmt = struct.Struct(fmt)
+    input_ = yield from _wait_for_input(fmt.size)
+    return input_.read_struct(fmt)
+
+
+_UINT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_UINT_STRUCTS = {
+    (size, byteorder): struct.Struct(prefix + fmt)
+    for size, fmt in _UINT_FORMATS.items()
+    for byteorder, prefix in [('big', '>'), ('little', '<')]
+}
+
+
+def read_uint(size: int,
+              byteorder: str='big') -> typing.Generator[_Action, typing.Union[Buffer, None], int]:
+    """Read an unsigned integer.
+
+    Args:
+        size (int): size of the integer in bytes.
+        byteorder (:obj:`str`, optional): ``'big'`` or ``'little'``.
+
+    Returns:
+        int: integer read.
+
+    Raises:
+        ValueError: When ``size`` is lower than 1, or ``byteorder`` is invalid.
+    """
+    if size < 1:
+        raise ValueError("Integers are at least 1 byte long, not {}".format(size))
+    if byteorder not in ('big', 'little'):
+        raise ValueError("byteorder must be 'big' or 'little', not {!r}".format(byteorder))
+    fmt = _UINT_STRUCTS.get((size, byteorder))
+    if fmt is not None:
+        value, = yield from read_struct(fmt)
+        return value
+    data = yield from read(size)
+    return int.from_bytes(data, byteorder)
+
+
+_Frame = typing.Tuple[tuple, bytes]
+
+
+def _peek_frame(input_: Buffer, header: struct.Struct, length_field: int,
+                max_size: int) -> typing.Optional[typing.Tuple[tuple, int]]:
+    """Get the header and body length of the frame at the head of the input.
+
+    Returns ``None`` when the frame isn't complete yet.
+    """
+    if len(input_) < header.size:
+        return None
+    values = input_.peek_struct(header)
+    length = values[length_field]
+    if length < 0:
+        raise ValueError("Negative frame body length: {}".format(length))
+    if max_size > 0 and length > max_size:
+        raise LimitExceeded("Frame body of {} bytes is larger than {} bytes".format(
+            length, max_size))
+    if len(input_) < header.size + length:
+        return None
+    return values, length
+
+
+def _read_frame(input_: Buffer, values: tuple, header: struct.Struct, length: int) -> _Frame:
+    input_.consume(header.size)
+    return values, input_.read(length) if length > 0 else b''
+
+
+def _wait_for_frame(header: struct.Struct, length_field: int, max_size: int
+                    ) -> typing.Generator[_Action, typing.Union[Buffer, None], Buffer]:
+    def complete(consumer: Consumer) -> bool:
+        try:
+            return _peek_frame(consumer.input, header, length_field, max_size) is not None
+        except LimitExceeded:
+            return True
+
+    input_ = yield _get_input
+    if _peek_frame(input_, header, length_field, max_size) is None:
+        yield from _wait_until('complete frame', complete)
+    return input_
+
+
+def read_frame(header: struct.Struct, length_field: int=0,
+               max_size: int=0) -> typing.Generator[_Action, typing.Union[Buffer, None], _Frame]:
+    """Read a length-prefixed frame.
+
+    A frame is a fixed-size header, one field of which is the length of the body following it.
+
+    Args:
+        header (struct.Struct): header of the frame.
+        length_field (:obj:`int`, optional): index of the body length in the unpacked header.
+        max_size (:obj:`int`, optional): maximum size of the body. ``0`` means no limit.
+
+    Returns:
+        tuple: ``(header, body)``, the unpacked header values and the body.
+
+    Raises:
+        LimitExceeded: When the body is larger than ``max_size``.
+        ValueError: When the length field is negative.
+
+    Example:
+
+        >>> HEADER = struct.Struct('!HB')
+        >>> @protocol
+        ... def reader():
+        ...    frame = yield from read_frame(HEADER)
+        ...    print("Read:", repr(frame))
+        ...
+        >>> conn = reader()
+        >>> conn.send(b'\\x00\\x05\\x01Hel')
+        >>> conn.send(b'lo')
+        Read: ((5, 1), b'Hello')
+    """
+    input_ = yield from _wait_for_frame(header, length_field, max_size)
+    frame = _peek_frame(input_, header, length_field, max_size)
+    assert frame is not None
+    values, length = frame
+    return _read_frame(input_, values, header, length)
+
+
+def read_frames(header: struct.Struct, length_field: int=0, max_frames: int=0, max_size: int=0
+                ) -> typing.Generator[_Action, typing.Union[Buffer, None], typing.List[_Frame]]:
+    """Read all the complete length-prefixed frames available.
+
+    This waits for at least one frame to be complete, and returns every complete frame in the
+    input at once, so the protocol isn't resumed once per frame.
+
+    Args:
+        header (struct.Struct): header of the frames, see :func:`~ohneio.read_frame`.
+        length_field (:obj:`int`, optional): index of the body length in the unpacked header.
+        max_frames (:obj:`int`, optional): maximum amount of frames to read. ``0`` means no
+            limit.
+        max_size (:obj:`int`, optional): maximum size of a body. ``0`` means no limit.
+
+    Returns:
+        list: ``(header, body)`` tuples.
+
+    Raises:
+        LimitExceeded: When a body is larger than ``max_size``.
+        ValueError: When a length field is negative.
+    """
+    input_ = yield from _wait_for_frame(header, length_field, max_size)
+    frames = []  # type: typing.List[_Frame]
+    while max_frames == 0 or len(frames) < max_frames:
+        frame = _peek_frame(input_, header, length_field, max_size)
+        if frame is None:
+            break
+        values, length = frame
+        frames.append(_read_frame(input_, values, header, length))
+    return frames
+
+
+def read_varint(max_size: int=10) -> typing.Generator[_Action, typing.Union[Buffer, None], int]:
+    """Read an unsigned LEB128 variable length integer.
+
+    Args:
+        max_size (:obj:`int`, optional): maximum size of the integer in bytes.
+
+    Returns:
+        int: integer read.
+
+    Raises:
+        LimitExceeded: When the integer is longer than ``max_size`` bytes.
+
+    Example:
+
+        >>> @protocol
+        ... def reader():
+        ...    value = yield from read_varint()
+        ...    print("Read:", value)
+        ...
+        >>> conn = reader()
+        >>> conn.send(b'\\xac')
+        >>> conn.send(b'\\x02')
+        Read: 300
+    """
+    def complete(consumer: Consumer) -> bool:
+        try:
+            return consumer.input.peek_varint(max_size) is not None
+        except LimitExceeded:
+            return True
+
+    input_ = yield _get_input
+    decoded = input_.peek_varint(max_size)
+    if decoded is None:
+        yield from _wait_until('variable length integer', complete)
+        decoded = input_.peek_varint(max_size)
+    assert decoded is not None
+    value, size = decoded
+    input_.consume(size)
+    return value
+
+
+def read_until(delimiter: bytes,
+               max_size: int=0) -> typing.Generator[_Action, typing.Union[Buffer, None], bytes]:
+    """Read and consume data up to a delimiter.
+
+    Wait for the delimiter to be available in the protocol input, then read and consume the data
+    up to and including the delimiter. Each time more data is available, only the new data is
+    scanned.
+
+    Args:
+        delimiter (bytes): delimiter to look for.
+        max_size (:obj:`int`, optional): maximum amount of bytes to read, including the delimiter.
+            ``0`` means no limit.
+
+    Returns:
+        bytes: data read, ending with the delimiter.
+
+    Raises:
+        LimitExceeded: When the delimiter wasn't found in the first ``max_size`` bytes.
+
+    Example:
+
+        >>> @protocol
+        ... def reader():
+        ...    data = yield from read_until(b'\\r\\n')
+        ...    print("Read:", repr(data))
+        ...
+        >>> conn = reader()
+        >>> conn.send(b'Hello\\r')
+        >>> conn.send(b'\\nWorld')
+        Read: b'Hello\\r\\n'
+    """
+    scanned = 0
+    pos = -1
+    cursor = None  # type: typing.Any
+
+    def scan(input_: Buffer) -> bool:
+        nonlocal scanned, pos, cursor
+        end = len(input_) if max_size == 0 else min(len(input_), max_size)
+        pos, cursor = input_._find(delimiter, max(scanned - len(delimiter) + 1, 0), end, cursor)
+        scanned = end
+        return pos >= 0 or (max_size > 0 and len(input_) >= max_size)
+
+    input_ = yield _get_input
+    if not scan(input_):
+        yield from _wait_until('delimiter {!r}'.format(delimiter),
+                               lambda consumer: scan(consumer.input))
+    if pos < 0:
+        raise LimitExceeded("Delimiter {!r} not found in the first {} bytes".format(
+            delimiter, max_size))
+    return input_.read(pos + len(delimiter))
+
+
+def readline(max_size: int=0) -> typing.Generator[_Action, typing.Union[Buffer, None], bytes]:
+    """Read and consume a line.
+
+    This is :func:`~ohneio.read_until` with ``b'\\n'`` as delimiter.
+
+    Args:
+        max_size (:obj:`int`, optional): maximum size of the line, including the new line.
+            ``0`` means no limit.
+
+    Returns:
+        bytes: line read, ending with ``b'\\n'``.
+
+    Raises:
+        LimitExceeded: When the line is longer than ``max_size``.
+    """
+    return (yield from read_until(b'\n', max_size))
+
+
+def write(data: bytes) -> typing.Generator[_Action, typing.Union[Buffer, None], None]:
+    """Write and flush data.
+
+    Write data to the protocol output. If this brings the output above the consumer's high
+    watermark, wait for it to be consumed down to the low watermark. With the default watermarks,
+    this waits for the output to be entirely consumed.
+
+    *This is a generator function that has to be used with ``yield from``.*
+
+    Args:
+        data (bytes): data to write to the output.
+
+    Returns:
+        None: Only when the data has been consumed down to the low watermark.
+
+    Example:
+
+        >>> @protocol
+        ... def foo():
+        ...     yield from write(b'foo')
+        ...     return "Done!"
+        ...
+        >>> conn = foo()
+        >>> conn.read(1)
+        b'f'
+        >>> conn.has_result
+        False
+        >>> conn.read(2)
+        b'oo'
+        >>> conn.get_result()
+        'Done!'
+    """
+    output, high_water = yield _get_output_limit
+    output.write(data)
+    if len(output) > high_water:
+        yield from _wait_until('output below low watermark',
+                               lambda consumer: not consumer.is_paused)
+
+
+def offload(func: typing.Callable[..., T], *args: typing.Any,
+            **kwargs: typing.Any) -> typing.Generator[_Action, typing.Any, T]:
+    """Run a function outside of the protocol, and wait for its result.
+
+    The protocol is suspended until the driver runs the function, typically in a thread pool,
+    see :meth:`Consumer.poll_offload`. This keeps CPU-heavy steps, like compression or hashing,
+    from blocking the event loop.
+
+    Args:
+        func (callable): function to run.
+        *args: positional arguments of ``func``.
+        **kwargs: keyword arguments of ``func``.
+
+    Returns:
+        The result of ``func``. If ``func`` raises, the exception is raised here.
+
+    Example:
+
+        >>> import zlib
+        >>> @protocol
+        ... def decompress():
+        ...     data = yield from read(13)
+        ...     return (yield from offload(zlib.decompress, data))
+        ...
+        >>> conn = decompress()
+        >>> conn.send(zlib.compress(b'Hello'))
+        >>> job = conn.poll_offload()
+        >>> conn.set_offload_result(job())
+        >>> conn.get_result()
+        b'Hello'
+    """
+    outcome = yield _Offload(functools.partial(func, *args, **kwargs))
+    if isinstance(outcome, _OffloadFailure):
+        raise outcome.exc
+    return outcome
+
+
+def emit(message: typing.Any) -> typing.Generator[_Action, typing.Any, None]:
+    """Emit a message, to be polled with :meth:`Consumer.poll_messages`.
+
+    This allows a long-lived protocol to hand out the messages it decodes as they come, instead
+    of returning a single result. When the consumer has a ``max_messages`` limit, and this many
+    messages are waiting to be polled, this waits for some of them to be polled.
+
+    Args:
+        message: any object.
+
+    Returns:
+        None
+
+    Example:
+
+        >>> @protocol(max_messages=2)
+        ... def numbers():
+        ...     for i in range(5):
+        ...         yield from emit(i)
+        ...     return 'Done'
+        ...
+        >>> conn = numbers()
+        >>> conn.poll_messages()
+        [0, 1]
+        >>> conn.poll_messages(1)
+        [2]
+        >>> conn.poll_messages()
+        [3, 4]
+        >>> conn.get_result()
+        'Done'
+    """
+    messages, max_messages = yield _get_messages
+    messages.append(message)
+    if max_messages > 0 and len(messages) >= max_messages:
+        yield from _wait_until('room for messages',
+                               lambda consumer: len(consumer._messages) < max_messages)
+
+
+def write_nowait(data: bytes) -> typing.Generator[_Action, typing.Union[Buffer, None], None]:
+    """Write data without waiting for it to be consumed.
+
+    Unlike :func:`~ohneio.write`, this never suspends the protocol, whatever the amount of output
+    pending.
+
+    Args:
+        data (bytes): data to write to the output.
+
+    Returns:
+        None
+    """
+    output = yield _get_output
+    output.write(data)
+
+
+def write_file(fileobj: typing.Any, offset: int=0, count: typing.Optional[int]=None
+               ) -> typing.Generator[_Action, typing.Union[Buffer, None], None]:
+    """Write a range of a file, without reading it.
+
+    The range is queued in the output as a :class:`~ohneio.FileSegment`. Drivers using
+    :meth:`Consumer.read_segments` can send it with :func:`os.sendfile`, the file is only read
+    when the output is read with :meth:`Consumer.read`. (Or when the output buffer is a
+    :class:`~ohneio.CompactBuffer`, which reads it right away.)
+
+    Like :func:`~ohneio.write`, this waits for the output to be consumed down to the low
+    watermark. The file has to stay open until then.
+
+    Args:
+        fileobj: binary file object, or anything with a ``fileno()`` method.
+        offset (:obj:`int`, optional): position of the range in the file.
+        count (:obj:`int`, optional): size of the range. Defaults to the rest of the file.
+
+    Returns:
+        None
+
+    Example:
+
+        >>> import tempfile
+        >>> @protocol
+        ... def serve(fileobj):
+        ...     yield from write(b'<')
+        ...     yield from write_file(fileobj, 6)
+        ...     yield from write(b'>')
+        ...
+        >>> with tempfile.TemporaryFile() as fp:
+        ...     _ = fp.write(b'Hello World')
+        ...     fp.flush()
+        ...     conn = serve(fp)
+        ...     conn.read_segments()
+        ...     conn.read()
+        [b'<']
+        b'<World>'
+    """
+    yield from write(FileSegment(fileobj, offset, count))
+
+
+R = typing.TypeVar('R')
+
+
+def protocol(func: typing.Optional[typing.Callable[..., ProtocolGenerator[R]]]=None,
+             **options: typing.Any) -> typing.Callable[..., typing.Any]:
+    """Wraps a Ohne I/O protocol function.
+
+    Under the hood this wraps the generator inside a :class:`~ohneio.Consumer`.
+
+    When called with keyword arguments only, this returns a decorator passing these options to
+    the :class:`~ohneio.Consumer`.
+
+    Args:
+        func (callable): Protocol function to wrap. (Protocol functions have to be generators)
+        **options: keyword arguments passed to :class:`~ohneio.Consumer`.
+
+    Returns:
+        callable: wrapped function.
+
+    Example:
+
+        >>> @protocol(output_high_water=8)
+        ... def foo():
+        ...     yield from write(b'foo')
+        ...     yield from write(b'bar')
+        ...     yield from write(b'baz')
+        ...     return "Done!"
+        ...
+        >>> conn = foo()
+        >>> conn.read(4)
+        b'foob'
+        >>> conn.is_paused
+        True
+        >>> conn.read()
+        b'arbaz'
+        >>> conn.get_result()
+        'Done!'
+    """
+    if func is None:
+        return functools.partial(protocol, **options)
+    if not callable(func):  # pragma: no cover
+        # This is for users misusing the library, type hinting already checks this
+        raise ValueError("A protocol needs to a be a callable")
+    if not inspect.isgeneratorfunction(func):  # pragma: no cover
+        # This is for users misusing the library, type hinting already checks this
+        raise ValueError("A protocol needs to be a generator function")
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return Consumer(func(*args, **kwargs), **options)
+
+    def from_mmap(path, *args, **kwargs):
+        return Consumer.from_mmap(func(*args, **kwargs), path, **options)
+
+    wrapper.from_mmap = from_mmap
+    return wrapper
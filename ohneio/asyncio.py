@@ -0,0 +1,293 @@
+"""Run Ohne I/O protocols on top of asyncio.
+
+This module requires Python 3.5+.
+"""
+import asyncio
+import concurrent.futures
+import typing
+
+import ohneio
+
+
+class ConsumerProtocol(asyncio.Protocol):
+    """asyncio protocol driving a :class:`~ohneio.Consumer`.
+
+    Data received from the transport is sent to the consumer, and the output of the consumer is
+    written to the transport, as long as the transport doesn't ask to pause writing. Reading from
+    the transport is paused while the consumer has :attr:`~ohneio.Consumer.reading_paused`, or
+    while its input buffer is full. Data received above the input buffer limit is kept aside, and
+    sent to the consumer as the protocol consumes its input. The connection only fails with
+    :exc:`~ohneio.LimitExceeded` when the protocol can't progress with a full input buffer.
+    Functions offloaded by the protocol with :func:`~ohneio.offload` are run in ``executor``.
+    Protocols waiting in :func:`~ohneio.sleep` or :func:`~ohneio.with_deadline` are ticked by a
+    timer of the loop, once their deadline passed.
+
+    Args:
+        consumer (Consumer): consumer to drive, as returned by a :func:`~ohneio.protocol`.
+        loop (:obj:`asyncio.AbstractEventLoop`, optional): event loop.
+        close_on_result (:obj:`bool`, optional): whether to close the transport once the
+            result of the protocol is available.
+        executor (:obj:`concurrent.futures.Executor`, optional): executor running the offloaded
+            functions. Defaults to the default executor of the loop.
+
+    Attributes:
+        result (asyncio.Future): resolved with the result of the protocol. Its exception isn't
+            logged when nobody awaits it, like when serving many connections.
+
+    Example:
+
+        >>> @ohneio.protocol
+        ... def echo():
+        ...     while True:
+        ...         line = yield from ohneio.readline()
+        ...         yield from ohneio.write(line)
+        ...
+        >>> loop = asyncio.get_event_loop()  # doctest: +SKIP
+        >>> server = loop.run_until_complete(  # doctest: +SKIP
+        ...     loop.create_server(lambda: ConsumerProtocol(echo(), loop=loop), 'localhost', 8000))
+    """
+
+    def __init__(self, consumer: ohneio.Consumer, *,
+                 loop: typing.Optional[asyncio.AbstractEventLoop]=None,
+                 close_on_result: bool=True,
+                 executor: typing.Optional[concurrent.futures.Executor]=None) -> None:
+        self.consumer = consumer
+        self.executor = executor
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.close_on_result = close_on_result
+        self.result = self.loop.create_future()
+        self.transport = None  # type: typing.Optional[asyncio.Transport]
+        self._writing_paused = False
+        self._reading_paused = False
+        self._pending = bytearray()  # Data received above the input buffer limit
+        self._offloading = False
+        self._deadline = None  # type: typing.Optional[float]
+        self._timer = None  # type: typing.Optional[asyncio.TimerHandle]
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = typing.cast(asyncio.Transport, transport)
+        self._flush()
+
+    def data_received(self, data: bytes) -> None:
+        capacity = self.consumer.input_capacity
+        if self._pending or (capacity is not None and len(data) > capacity):
+            self._pending.extend(data)
+        else:
+            try:
+                self.consumer.send(data)
+            except Exception as e:
+                self._fail(e)
+                return
+        self._flush()
+
+    def eof_received(self) -> bool:
+        self._flush()
+        return False
+
+    def connection_lost(self, exc: typing.Optional[Exception]) -> None:
+        self._cancel_timer()
+        self.consumer.close()
+        self._set_exception(exc if exc is not None else ohneio.NoResult())
+
+    def pause_writing(self) -> None:
+        self._writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+        self._flush()
+
+    def _fail(self, exc: Exception) -> None:
+        self.consumer.close()
+        self._set_exception(exc)
+        assert self.transport is not None
+        self.transport.close()
+
+    def _set_exception(self, exc: BaseException) -> None:
+        if self.result.done():
+            return
+        self.result.set_exception(exc)
+        self.result.exception()  # Mark it retrieved, the result is often never awaited
+
+    def _flush(self) -> None:
+        assert self.transport is not None
+        try:
+            while True:
+                while not self._writing_paused:
+                    data = self.consumer.read()
+                    if not data:
+                        break
+                    self.transport.write(data)
+                if not self._send_pending():
+                    break
+            self._offload()
+            if self._stalled():
+                raise ohneio.LimitExceeded("Protocol stalled with a full input buffer")
+            if self.result.done() or not self.consumer.has_result:
+                return
+            self.result.set_result(self.consumer.get_result())
+        except Exception as e:
+            self._fail(e)
+            return
+        finally:
+            self._update_reading()
+            self._update_timer()
+        if self.close_on_result:
+            self.transport.close()
+
+    def _send_pending(self) -> bool:
+        """Send the data kept aside to the consumer, as much as its input buffer accepts.
+
+        Returns:
+            bool: whether any data was sent.
+        """
+        pending = self._pending
+        if not pending or self.consumer.closed:
+            return False
+        capacity = self.consumer.input_capacity
+        if capacity == 0:
+            return False
+        size = len(pending) if capacity is None else min(capacity, len(pending))
+        chunk = bytes(pending[:size])
+        del pending[:size]
+        self.consumer.send(chunk)
+        return True
+
+    def _stalled(self) -> bool:
+        consumer = self.consumer
+        return (bool(self._pending) and consumer.input_capacity == 0 and not consumer.closed and
+                not consumer.writable and not self._offloading and
+                consumer.next_deadline() is None)
+
+    def _offload(self) -> None:
+        job = self.consumer.poll_offload()
+        if job is not None:
+            self._offloading = True
+            future = self.loop.run_in_executor(self.executor, job)
+            future.add_done_callback(self._offload_done)
+
+    def _offload_done(self, future: asyncio.Future) -> None:
+        self._offloading = False
+        if self.transport is None or self.transport.is_closing():
+            return
+        exc = future.exception()
+        try:
+            if exc is not None:
+                self.consumer.set_offload_exception(exc)
+            else:
+                self.consumer.set_offload_result(future.result())
+        except Exception as e:
+            self._fail(e)
+            return
+        self._flush()
+
+    def _update_timer(self) -> None:
+        assert self.transport is not None
+        if self.transport.is_closing():
+            self._cancel_timer()
+            return
+        try:
+            deadline = self.consumer.next_deadline()
+        except Exception as e:
+            self._fail(e)
+            return
+        if deadline == self._deadline:
+            return
+        self._cancel_timer()
+        if deadline is not None:
+            delay = max(deadline - self.consumer.clock(), 0)
+            self._timer = self.loop.call_later(delay, self._on_timer)
+            self._deadline = deadline
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = None
+        self._deadline = None
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._deadline = None
+        if self.transport is None or self.transport.is_closing():
+            return
+        try:
+            self.consumer.tick()
+        except Exception as e:
+            self._fail(e)
+            return
+        self._flush()
+
+    def _update_reading(self) -> None:
+        assert self.transport is not None
+        paused = (self.consumer.reading_paused or self.consumer.input_capacity == 0 or
+                  bool(self._pending))
+        if paused == self._reading_paused:
+            return
+        self._reading_paused = paused
+        if paused:
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+
+async def run_protocol(proto_factory: typing.Callable[[], ohneio.Consumer],
+                       reader: asyncio.StreamReader, writer: asyncio.StreamWriter, *,
+                       read_size: int=65536,
+                       executor: typing.Optional[concurrent.futures.Executor]=None
+                       ) -> typing.Any:
+    """Run a protocol over asyncio streams, until its result is available.
+
+    Args:
+        proto_factory (callable): called without arguments to get the consumer.
+        reader (asyncio.StreamReader): stream to read the protocol input from.
+        writer (asyncio.StreamWriter): stream to write the protocol output to.
+        read_size (:obj:`int`, optional): amount of bytes to read at most at once.
+        executor (:obj:`concurrent.futures.Executor`, optional): executor running the functions
+            offloaded by the protocol. Defaults to the default executor of the loop.
+
+    Protocols waiting in :func:`~ohneio.sleep` or :func:`~ohneio.with_deadline` are ticked once
+    their deadline passed, even when no data is received.
+
+    Returns:
+        The result of the protocol.
+
+    Raises:
+        NoResult: When the end of the stream is reached before the protocol returned.
+        LimitExceeded: When the input buffer limit of the consumer is reached.
+    """
+    loop = asyncio.get_event_loop()
+    consumer = proto_factory()
+    while True:
+        data = consumer.read()
+        if data:
+            writer.write(data)
+            await writer.drain()
+        if consumer.has_result:
+            return consumer.get_result()
+
+        job = consumer.poll_offload()
+        if job is not None:
+            try:
+                result = await loop.run_in_executor(executor, job)
+            except Exception as e:
+                consumer.set_offload_exception(e)
+            else:
+                consumer.set_offload_result(result)
+            continue
+
+        capacity = consumer.input_capacity
+        if capacity == 0:
+            raise ohneio.LimitExceeded("Input buffer limit reached")
+        size = read_size if capacity is None else min(read_size, capacity)
+        deadline = consumer.next_deadline()
+        if deadline is None:
+            data = await reader.read(size)
+        else:
+            try:
+                data = await asyncio.wait_for(reader.read(size),
+                                              max(deadline - consumer.clock(), 0))
+            except asyncio.TimeoutError:
+                consumer.tick()
+                continue
+        if not data:
+            raise ohneio.NoResult("End of stream reached before the protocol returned")
+        consumer.send(data)
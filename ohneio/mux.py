@@ -0,0 +1,274 @@
+"""Drive many protocols over non-blocking sockets from a single selector loop."""
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import time
+import typing
+
+import ohneio
+
+
+# Maximum amount of segments passed at once to sendmsg(), POSIX guarantees at least 16, Linux
+# and BSDs support 1024.
+IOV_MAX = 1024
+
+
+DoneCallback = typing.Callable[[ohneio.Consumer, typing.Optional[Exception]], None]
+
+
+class _Connection:
+    __slots__ = ('sock', 'consumer', 'on_done', 'events', 'eof', 'deadline')
+
+    def __init__(self, sock: socket.socket, consumer: ohneio.Consumer,
+                 on_done: typing.Optional[DoneCallback]) -> None:
+        self.sock = sock
+        self.consumer = consumer
+        self.on_done = on_done
+        self.events = 0
+        self.eof = False
+        self.deadline = None  # type: typing.Optional[float]
+
+
+class _Listener:
+    __slots__ = ('sock', 'protocol_factory', 'on_done')
+
+    def __init__(self, sock: socket.socket, protocol_factory: typing.Callable[[], ohneio.Consumer],
+                 on_done: typing.Optional[DoneCallback]) -> None:
+        self.sock = sock
+        self.protocol_factory = protocol_factory
+        self.on_done = on_done
+
+
+class Multiplexer:
+    """Selector loop driving one :class:`~ohneio.Consumer` per socket.
+
+    Data is received with :meth:`socket.socket.recv_into` into a single reusable buffer, and only
+    the bytes received are copied into the consumer. Output is written with
+    :meth:`socket.socket.sendmsg` from the output segments of the consumer, once the socket is
+    writable. Ranges of files written with :func:`~ohneio.write_file` are sent with
+    :func:`os.sendfile` when available. Reading from a socket is suspended while its consumer has
+    :attr:`~ohneio.Consumer.reading_paused`.
+
+    The deadlines of the protocols waiting in :func:`~ohneio.sleep` or
+    :func:`~ohneio.with_deadline` are kept in a single timer heap, and the consumers are ticked
+    once they passed. Consumers have to use the default ``clock``, :func:`time.monotonic`.
+
+    A socket is closed once its protocol ended and its output was entirely sent, or when the peer
+    closed the connection, or when the protocol raised an exception. ``on_done(consumer, exc)``
+    is then called, ``exc`` being ``None`` when the protocol ended normally. Accepted connections
+    are closed right away when ``protocol_factory`` raises an exception.
+
+    Args:
+        recv_size (:obj:`int`, optional): amount of bytes received at most at once.
+        selector (:obj:`selectors.BaseSelector`, optional): selector to use.
+
+    Attributes:
+        connections (dict): file descriptor to connection, for every open connection.
+
+    Example:
+
+        >>> @ohneio.protocol
+        ... def echo():
+        ...     while True:
+        ...         line = yield from ohneio.readline()
+        ...         yield from ohneio.write(line)
+        ...
+        >>> mux = Multiplexer()
+        >>> mux.listen(socket.create_server(('localhost', 8000)), echo)  # doctest: +SKIP
+        >>> mux.run()  # doctest: +SKIP
+    """
+
+    def __init__(self, *, recv_size: int=65536,
+                 selector: typing.Optional[selectors.BaseSelector]=None) -> None:
+        self.selector = selector if selector is not None else selectors.DefaultSelector()
+        self.recv_size = recv_size
+        self._recv_buffer = memoryview(bytearray(recv_size))
+        self.connections = {}  # type: typing.Dict[int, _Connection]
+        self._timers = []  # type: typing.List[typing.Tuple[float, int, _Connection]]
+        self._timer_ids = itertools.count()
+
+    def register(self, sock: socket.socket, consumer: ohneio.Consumer,
+                 on_done: typing.Optional[DoneCallback]=None) -> None:
+        """Drive ``consumer`` with the data of ``sock``.
+
+        The socket is set non-blocking.
+        """
+        sock.setblocking(False)
+        conn = _Connection(sock, consumer, on_done)
+        self.connections[sock.fileno()] = conn
+        try:
+            self._update(conn)
+        except Exception as e:
+            self._fail(conn, e)
+
+    def listen(self, sock: socket.socket, protocol_factory: typing.Callable[[], ohneio.Consumer],
+               on_done: typing.Optional[DoneCallback]=None) -> None:
+        """Accept connections on a listening socket.
+
+        ``protocol_factory`` is called without arguments for every new connection.
+        """
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, _Listener(sock, protocol_factory,
+                                                                     on_done))
+
+    def run_once(self, timeout: typing.Optional[float]=None) -> int:
+        """Wait for socket events and process them.
+
+        Returns:
+            int: amount of events processed.
+        """
+        if self._timers:
+            delay = max(self._timers[0][0] - time.monotonic(), 0)
+            timeout = delay if timeout is None else min(timeout, delay)
+        events = self.selector.select(timeout)
+        for key, mask in events:
+            data = key.data
+            if isinstance(data, _Listener):
+                self._accept(data)
+                continue
+            if data.sock.fileno() not in self.connections:  # Closed by a previous event
+                continue
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    self._write(data)
+                if mask & selectors.EVENT_READ:
+                    self._read(data)
+                self._update(data)
+            except Exception as e:
+                self._fail(data, e)
+        self._run_timers()
+        return len(events)
+
+    def run(self, timeout: typing.Optional[float]=None) -> None:
+        """Process socket events until no socket is left.
+
+        Listening sockets count as sockets left, this will only return after :meth:`close`.
+        """
+        while self.selector.get_map() or self.connections:
+            self.run_once(timeout)
+
+    def close(self) -> None:
+        """Close every connection and listening socket."""
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, _Listener):
+                self.selector.unregister(key.fileobj)
+                key.data.sock.close()
+        for conn in list(self.connections.values()):
+            self._finish(conn, ohneio.NoResult("Multiplexer closed"))
+        self.selector.close()
+
+    def _accept(self, listener: _Listener) -> None:
+        try:
+            sock, _ = listener.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        try:
+            consumer = listener.protocol_factory()
+        except Exception:
+            sock.close()
+            return
+        self.register(sock, consumer, listener.on_done)
+
+    def _read(self, conn: _Connection) -> None:
+        capacity = conn.consumer.input_capacity
+        size = self.recv_size if capacity is None else min(self.recv_size, capacity)
+        try:
+            nbytes = conn.sock.recv_into(self._recv_buffer, size)
+        except (BlockingIOError, InterruptedError):
+            return
+        if nbytes == 0:
+            conn.eof = True
+            return
+        conn.consumer.send(bytes(self._recv_buffer[:nbytes]))
+
+    def _write(self, conn: _Connection) -> None:
+        segments = conn.consumer.read_segments()[:IOV_MAX]
+        if not segments:
+            return
+        try:
+            if isinstance(segments[0], ohneio.FileSegment):
+                sent = self._sendfile(conn.sock, segments[0])
+            else:
+                for i, segment in enumerate(segments):
+                    if isinstance(segment, ohneio.FileSegment):
+                        segments = segments[:i]
+                        break
+                sent = conn.sock.sendmsg(segments)
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.consumer.consume(sent)
+
+    def _sendfile(self, sock: socket.socket, segment: ohneio.FileSegment) -> int:
+        if not hasattr(os, 'sendfile'):  # pragma: no cover
+            return sock.send(bytes(segment[:self.recv_size]))
+        sent = os.sendfile(sock.fileno(), segment.fileno(), segment.offset, len(segment))
+        if sent == 0:
+            raise EOFError("{} bytes missing at the end of the file".format(len(segment)))
+        return sent
+
+    def _run_timers(self) -> None:
+        timers = self._timers
+        now = time.monotonic()
+        while timers and timers[0][0] <= now:
+            deadline, _, conn = heapq.heappop(timers)
+            # Skip the timers of closed connections, and the ones replaced by a new deadline
+            if conn.deadline != deadline or self.connections.get(conn.sock.fileno()) is not conn:
+                continue
+            conn.deadline = None
+            try:
+                conn.consumer.tick()
+                self._update(conn)
+            except Exception as e:
+                self._fail(conn, e)
+
+    def _update(self, conn: _Connection) -> None:
+        consumer = conn.consumer
+        if not consumer.writable:
+            if consumer.closed:
+                self._finish(conn, None)
+                return
+            if conn.eof:
+                self._finish(conn, ohneio.NoResult("Connection closed before the protocol "
+                                                   "returned"))
+                return
+
+        deadline = consumer.next_deadline()
+        if deadline is not None and deadline != conn.deadline:
+            heapq.heappush(self._timers, (deadline, next(self._timer_ids), conn))
+        conn.deadline = deadline
+
+        events = 0
+        if not (consumer.closed or conn.eof or consumer.reading_paused or
+                consumer.input_capacity == 0):
+            events |= selectors.EVENT_READ
+        if consumer.writable:
+            events |= selectors.EVENT_WRITE
+        if events == 0:
+            if deadline is None:
+                self._finish(conn, ohneio.LimitExceeded("Protocol stalled with a full input "
+                                                        "buffer"))
+                return
+            if conn.events != 0:  # Only waiting for the deadline
+                self.selector.unregister(conn.sock)
+        elif conn.events == 0:
+            self.selector.register(conn.sock, events, conn)
+        elif events != conn.events:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def _fail(self, conn: _Connection, exc: Exception) -> None:
+        # The connection could have been finished before the exception was raised
+        if self.connections.get(conn.sock.fileno()) is conn:
+            self._finish(conn, exc)
+
+    def _finish(self, conn: _Connection, exc: typing.Optional[Exception]) -> None:
+        if conn.events != 0:
+            self.selector.unregister(conn.sock)
+            conn.events = 0
+        del self.connections[conn.sock.fileno()]
+        conn.sock.close()
+        conn.consumer.close()
+        if conn.on_done is not None:
+            conn.on_done(conn.consumer, exc)
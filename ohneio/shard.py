@@ -0,0 +1,185 @@
+"""Spread protocol connections over several worker processes.
+
+Each worker process runs its own :class:`~ohneio.mux.Multiplexer`. Connections are either
+accepted from a listening socket shared by all the workers, or, with ``reuse_port=True``, from
+one listening socket per worker bound with ``SO_REUSEPORT``, letting the kernel balance them.
+"""
+import multiprocessing
+import os
+import socket
+import typing
+
+import ohneio
+from ohneio.mux import Multiplexer
+
+
+Address = typing.Tuple[str, int]
+
+
+def _bind(address: Address, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def _worker(index: int, protocol_factory: typing.Callable[[], ohneio.Consumer],
+            listener: typing.Union[socket.socket, Address], backlog: int, recv_size: int,
+            connections: typing.Any, completed: typing.Any, ready: typing.Any) -> None:
+    if isinstance(listener, socket.socket):
+        sock = listener
+    else:
+        sock = _bind(listener, reuse_port=True)
+        sock.listen(backlog)
+
+    def on_done(consumer: ohneio.Consumer, exc: typing.Optional[Exception]) -> None:
+        completed[index] += 1
+
+    mux = Multiplexer(recv_size=recv_size)
+    mux.listen(sock, protocol_factory, on_done)
+    ready.set()
+    try:
+        while True:
+            mux.run_once(timeout=1.0)
+            connections[index] = len(mux.connections)
+    finally:
+        mux.close()
+
+
+class ShardedServer:
+    """Serve a protocol from several worker processes.
+
+    Args:
+        protocol_factory (callable): called without arguments for every new connection. It has to
+            be picklable when the multiprocessing start method isn't ``fork``.
+        address (tuple): ``(host, port)`` to listen on. Port ``0`` picks a free port.
+        workers (:obj:`int`, optional): amount of worker processes. Defaults to the amount of
+            CPUs.
+        reuse_port (:obj:`bool`, optional): whether each worker listens on its own socket with
+            ``SO_REUSEPORT``, instead of sharing a single listening socket.
+        backlog (:obj:`int`, optional): backlog of the listening sockets.
+        recv_size (:obj:`int`, optional): see :class:`~ohneio.mux.Multiplexer`.
+        mp_context (:obj:`multiprocessing.context.BaseContext`, optional): multiprocessing
+            context used to start the workers.
+
+    Example:
+
+        >>> @ohneio.protocol
+        ... def echo():
+        ...     while True:
+        ...         line = yield from ohneio.readline()
+        ...         yield from ohneio.write(line)
+        ...
+        >>> with ShardedServer(echo, ('localhost', 8000), workers=4) as server:  # doctest: +SKIP
+        ...     while True:
+        ...         time.sleep(1)
+        ...         server.check()
+    """
+
+    def __init__(self, protocol_factory: typing.Callable[[], ohneio.Consumer], address: Address,
+                 *, workers: typing.Optional[int]=None, reuse_port: bool=False,
+                 backlog: int=128, recv_size: int=65536,
+                 mp_context: typing.Any=None) -> None:
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):  # pragma: no cover
+            raise ValueError("SO_REUSEPORT isn't supported on this platform")
+        self.protocol_factory = protocol_factory
+        self.requested_address = address
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.recv_size = recv_size
+        self.context = mp_context if mp_context is not None else multiprocessing.get_context()
+        self.processes = []  # type: typing.List[typing.Any]
+        self._socket = None  # type: typing.Optional[socket.socket]
+        self._connections = self.context.Array('l', self.workers)
+        self._completed = self.context.Array('l', self.workers)
+
+    @property
+    def address(self) -> Address:
+        """tuple: address the server listens on"""
+        if self._socket is None:
+            raise RuntimeError("The server isn't started")
+        return self._socket.getsockname()[:2]
+
+    def start(self) -> None:
+        """Bind the listening socket and start the workers."""
+        self._socket = _bind(self.requested_address, self.reuse_port)
+        if not self.reuse_port:
+            # With SO_REUSEPORT, the socket of the supervisor only reserves the port, since it
+            # isn't listening, the kernel never hands it any connection.
+            self._socket.listen(self.backlog)
+        self.processes = [self._spawn(index) for index in range(self.workers)]
+
+    def _spawn(self, index: int) -> typing.Any:
+        assert self._socket is not None
+        listener = self.address if self.reuse_port else self._socket
+        ready = self.context.Event()
+        process = self.context.Process(
+            target=_worker, name='ohneio-worker-{}'.format(index), daemon=True,
+            args=(index, self.protocol_factory, listener, self.backlog, self.recv_size,
+                  self._connections, self._completed, ready))
+        process.start()
+        # Wait for the worker to listen, otherwise connections could be refused with reuse_port
+        while not ready.wait(0.1):
+            if not process.is_alive():
+                raise RuntimeError("Worker {} died while starting".format(index))
+        return process
+
+    def restart(self, index: int) -> None:
+        """Stop the worker ``index``, if it's running, and start a new one."""
+        process = self.processes[index]
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        self._connections[index] = 0
+        self.processes[index] = self._spawn(index)
+
+    def check(self) -> typing.List[int]:
+        """Restart the workers which died.
+
+        Returns:
+            list: indexes of the restarted workers.
+        """
+        dead = [index for index, process in enumerate(self.processes) if not process.is_alive()]
+        for index in dead:
+            self.restart(index)
+        return dead
+
+    def load(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Report the load of each worker.
+
+        Returns:
+            list: one dictionary per worker, with its ``pid``, whether it is ``alive``, its amount
+            of open ``connections``, and the amount of ``completed`` connections.
+        """
+        return [{
+            'pid': process.pid,
+            'alive': process.is_alive(),
+            'connections': self._connections[index],
+            'completed': self._completed[index],
+        } for index, process in enumerate(self.processes)]
+
+    def stop(self) -> None:
+        """Stop the workers and close the listening socket."""
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def __enter__(self) -> 'ShardedServer':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.stop()
@@ -24,7 +24,7 @@ setup(name="ohneio",
       author="Antoine Catton",
       author_email="devel@antoine.catton.fr",
       url="https://github.com/acatton/ohneio",
-      py_modules=['ohneio'],
+      packages=['ohneio'],
       install_requires=install_requires,
       classifiers=[
           "Intended Audience :: Developers",
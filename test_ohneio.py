@@ -1,3 +1,6 @@
+import io
+import struct
+
 import pytest
 
 import ohneio
@@ -5,6 +8,12 @@ import ohneio
 BUFFER_SIZES = [1, 2, 3, 5, 7, 16, 100, 210, 256]
 
 
+@pytest.fixture(params=[ohneio.Buffer, ohneio.CompactBuffer])
+def buffer_class(request, monkeypatch):
+    monkeypatch.setattr(ohneio.Consumer, 'buffer_factory', request.param)
+    return request.param
+
+
 @ohneio.protocol
 def echo_n_bytes(nbytes):
     while True:
@@ -14,16 +23,16 @@ def echo_n_bytes(nbytes):
 
 @pytest.mark.parametrize('read_len', BUFFER_SIZES)
 @pytest.mark.parametrize('write_len', BUFFER_SIZES)
-def test_buffer(read_len, write_len):
-    buf = ohneio.Buffer()
+def test_buffer(read_len, write_len, buffer_class):
+    buf = buffer_class()
     data = bytes(write_len)
     buf.write(data)
     assert len(buf.read(read_len)) == min(write_len, read_len)
     assert len(buf.read(read_len)) == min(max(write_len - read_len, 0), read_len)
 
 
-def test_buffer_read_same_segment_multiple_times():
-    buf = ohneio.Buffer()
+def test_buffer_read_same_segment_multiple_times(buffer_class):
+    buf = buffer_class()
     data = [b'Hello', b'world']
     for segment in data:
         buf.write(segment)
@@ -31,8 +40,8 @@ def test_buffer_read_same_segment_multiple_times():
         assert buf.read(1) == bytes([b])
 
 
-def test_buffer_read_chunks_over_different_segments():
-    buf = ohneio.Buffer()
+def test_buffer_read_chunks_over_different_segments(buffer_class):
+    buf = buffer_class()
     for segment in [b'Hello', b'World', b'No?']:
         buf.write(segment)
     assert buf.read(3) == b'Hel'
@@ -41,9 +50,206 @@ def test_buffer_read_chunks_over_different_segments():
     assert buf.read(4) == b'dNo?'
 
 
+def test_buffer_ignores_empty_segments():
+    buf = ohneio.Buffer()
+    buf.write(b'')
+    buf.write(b'foo')
+    buf.write(b'')
+    assert len(buf) == 3
+    assert len(buf.queue) == 1
+
+
+MANY_SEGMENTS = 100000
+
+
+def test_buffer_many_small_segments_length(buffer_class):
+    buf = buffer_class()
+    for i in range(MANY_SEGMENTS):
+        buf.write(bytes([i % 256]))
+        assert len(buf) == i + 1
+    for i in range(MANY_SEGMENTS):
+        assert buf.read(1) == bytes([i % 256])
+        assert len(buf) == MANY_SEGMENTS - i - 1
+
+
+@pytest.mark.parametrize('read_len', BUFFER_SIZES)
+def test_buffer_many_small_segments_read(read_len, buffer_class):
+    data = bytes(i % 256 for i in range(MANY_SEGMENTS))
+    buf = buffer_class()
+    for b in data:
+        buf.write(bytes([b]))
+
+    assert buf.peek(read_len) == data[:read_len]
+    chunks = []
+    while len(buf) > 0:
+        chunks.append(buf.read(read_len))
+    assert b''.join(chunks) == data
+    assert all(len(chunk) == read_len for chunk in chunks[:-1])
+
+
+def test_echo_many_small_segments(buffer_class):
+    conn = echo_n_bytes(1000)
+    data = bytes(i % 256 for i in range(MANY_SEGMENTS))
+    output = []
+    for b in data:
+        conn.send(bytes([b]))
+        output.append(conn.read())
+    assert b''.join(output) == data
+
+
+def test_buffer_views_do_not_copy_single_segment():
+    segment = b'Hello World'
+    buf = ohneio.Buffer()
+    buf.write(segment)
+    buf.write(b'!')
+
+    view = buf.peek_view(5)
+    assert view.obj is segment
+    assert view == b'Hello'
+    view = buf.read_view(5)
+    assert view.obj is segment
+    assert view == b'Hello'
+    assert buf.read_view() == b' World!'
+    assert len(buf) == 0
+
+
+def test_buffer_read_returns_bytes_from_views(buffer_class):
+    buf = buffer_class()
+    buf.write(memoryview(b'Hello'))
+    data = buf.read(2)
+    assert type(data) is bytes
+    assert data == b'He'
+
+
+@pytest.mark.parametrize('read_len', BUFFER_SIZES)
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+def test_buffer_readinto(read_len, segment_len, buffer_class):
+    data = bytes(range(256))
+    buf = buffer_class()
+    for start in range(0, len(data), segment_len):
+        buf.write(data[start:start + segment_len])
+
+    target = bytearray(read_len)
+    output = []
+    while len(buf) > 0:
+        nbytes = buf.readinto(target)
+        assert nbytes == min(read_len, len(data) - len(b''.join(output)))
+        output.append(bytes(target[:nbytes]))
+    assert b''.join(output) == data
+    assert buf.readinto(target) == 0
+
+
+def test_buffer_segments_and_consume():
+    buf = ohneio.Buffer()
+    for segment in [b'Hello', b' ', b'World']:
+        buf.write(segment)
+    buf.read(1)
+
+    assert [bytes(s) for s in buf.segments()] == [b'ello', b' ', b'World']
+    assert [bytes(s) for s in buf.segments(7)] == [b'ello', b' ', b'Wo']
+    assert len(buf) == 10
+
+    buf.consume(6)
+    assert [bytes(s) for s in buf.segments()] == [b'orld']
+    with pytest.raises(ValueError):
+        buf.consume(5)
+    buf.consume(4)
+    assert buf.segments() == []
+
+
+def test_compact_buffer_compaction():
+    buf = ohneio.CompactBuffer(max_waste=4)
+    buf.write(b'0123456789')
+    assert buf.read(4) == b'0123'
+    assert buf.start == 4  # At most max_waste bytes wasted
+    assert buf.read(2) == b'45'
+    assert buf.start == 0  # More wasted bytes than buffered ones
+    assert bytes(buf.data) == b'6789'
+
+    buf.read(4)
+    assert len(buf.data) == 0
+
+
+def test_compact_buffer_views_are_copies():
+    buf = ohneio.CompactBuffer()
+    buf.write(b'Hello')
+    view = buf.peek_view(2)
+    segments = buf.segments()
+    buf.write(b' World')  # The array can still be resized
+    assert buf.read_view(5) == b'Hello'
+    assert view == b'He'
+    assert segments == [b'Hello']
+    assert buf.segment_count == 1
+    buf.consume(6)
+    assert buf.segment_count == 0
+
+
+def test_consumer_buffer_factory():
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(2), buffer_factory=ohneio.CompactBuffer)
+    assert isinstance(conn.input, ohneio.CompactBuffer)
+    assert isinstance(conn.output, ohneio.CompactBuffer)
+    conn.send(b'foo')
+    assert conn.read() == b'fo'
+
+
+def test_buffer_pool(buffer_class):
+    pool = ohneio.BufferPool(buffer_class, max_size=2, max_capacity=1024)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert (pool.hits, pool.misses) == (0, 2)
+
+    first.write(b'foo')
+    pool.release(first)
+    pool.release(second)
+    pool.release(buffer_class())  # The pool is full
+    assert len(pool) == 2
+    assert pool.discards == 1
+
+    buf = pool.acquire()
+    assert buf is second or buf is first
+    assert len(buf) == 0
+    assert pool.hits == 1
+
+    buf.write(bytes(2048))
+    pool.release(buf)  # Too large to be kept
+    assert pool.discards == 2
+    assert len(pool) == 1
+
+
+@ohneio.protocol
+def greeter():
+    name = yield from ohneio.readline()
+    yield from ohneio.write_nowait(b'Hello ' + name)
+    return name
+
+
+def test_consumer_pool(buffer_class):
+    pool = ohneio.BufferPool(buffer_class)
+    conn = ohneio.Consumer(greeter.__wrapped__(), pool=pool)
+    conn.send(b'World\n')
+    assert conn.get_result() == b'World\n'
+    assert len(pool) == 1  # The input, the output is still pending
+    conn.send(b'ignored')
+    assert conn.read(6) == b'Hello '
+    assert len(pool) == 1
+    assert conn.read() == b'World\n'
+    assert len(pool) == 2
+
+    conn = ohneio.Consumer(greeter.__wrapped__(), pool=pool)
+    assert (pool.hits, pool.misses) == (2, 2)
+    conn.send(b'Wor')
+    conn.close()
+    assert len(pool) == 2
+    assert len(conn.input) == 0
+    conn.send(b'ld\n')
+    assert not conn.has_result
+    with pytest.raises(RuntimeError):
+        conn.input.write(b'x')  # Shared by the consumers which gave their buffers back
+
+
 @pytest.mark.parametrize('nbytes', BUFFER_SIZES)
 @pytest.mark.parametrize('data_len', BUFFER_SIZES)
-def test_echo_n_bytes(nbytes, data_len):
+def test_echo_n_bytes(nbytes, data_len, buffer_class):
     conn = echo_n_bytes(nbytes)
     data = b'\x00' * data_len
 
@@ -56,6 +262,860 @@ def test_echo_n_bytes(nbytes, data_len):
     assert len(conn.read(nbytes)) == nbytes
 
 
+@pytest.mark.parametrize('nbytes', BUFFER_SIZES)
+def test_consumer_readinto(nbytes, buffer_class):
+    conn = echo_n_bytes(nbytes)
+    conn.send(bytes(range(256)) * 2)
+    target = bytearray(300)
+    view = memoryview(target)
+    received = conn.readinto(view)
+    assert received == min(300, 512 - 512 % nbytes)
+    assert target[:received] == (bytes(range(256)) * 2)[:received]
+
+
+@ohneio.protocol
+def framed_writer(payloads):
+    for payload in payloads:
+        yield from ohneio.write(len(payload).to_bytes(2, 'big'))
+        yield from ohneio.write(payload)
+
+
+def test_consumer_read_segments(buffer_class):
+    payloads = [b'Hello', b'World']
+    conn = framed_writer(payloads)
+    sent = []
+    while True:
+        segments = conn.read_segments()
+        if not segments:
+            break
+        # Simulate a partial send
+        data = b''.join(segments)[:3]
+        sent.append(data)
+        conn.consume(len(data))
+    assert b''.join(sent) == b'\x00\x05Hello\x00\x05World'
+
+
+@pytest.fixture
+def hello_file(tmpdir):
+    with open(str(tmpdir.join('hello')), 'w+b') as fp:
+        fp.write(b'Hello World')
+        fp.flush()
+        yield fp
+
+
+def test_file_segment(hello_file):
+    segment = ohneio.FileSegment(hello_file, 6)
+    assert len(segment) == 5
+    assert bytes(segment) == b'World'
+    part = segment[1:3]
+    assert (part.offset, len(part), bytes(part)) == (7, 2, b'or')
+    assert part.fileno() == hello_file.fileno()
+    with pytest.raises(EOFError):
+        bytes(ohneio.FileSegment(hello_file, 6, 10))
+
+
+@ohneio.protocol(output_high_water=64)
+def file_writer(fileobj):
+    yield from ohneio.write_nowait(b'<')
+    yield from ohneio.write_file(fileobj, 0, 5)
+    yield from ohneio.write_nowait(b' ')
+    yield from ohneio.write_file(fileobj, 6)
+    yield from ohneio.write(b'>')
+
+
+def test_write_file_segments(hello_file, buffer_class):
+    conn = file_writer(hello_file)
+    segments = conn.read_segments()
+    if buffer_class is ohneio.Buffer:
+        assert [type(segment) for segment in segments] == [
+            bytes, ohneio.FileSegment, bytes, ohneio.FileSegment, bytes]
+    assert b''.join(bytes(segment) for segment in segments) == b'<Hello World>'
+
+    conn.consume(3)
+    segments = conn.read_segments(4)
+    assert b''.join(bytes(segment) for segment in segments) == b'llo '
+    conn.consume(4)
+    assert conn.read() == b'World>'
+
+
+@pytest.mark.parametrize('nbytes', BUFFER_SIZES)
+def test_write_file_readinto(hello_file, nbytes, buffer_class):
+    conn = file_writer(hello_file)
+    target = bytearray(nbytes)
+    output = []
+    while True:
+        received = conn.readinto(target)
+        if received == 0:
+            break
+        output.append(bytes(target[:received]))
+    assert b''.join(output) == b'<Hello World>'
+
+
+class CountingConsumer(ohneio.Consumer):
+    resumptions = 0
+
+    def _next_state(self, value=None):
+        self.resumptions += 1
+        super()._next_state(value)
+
+
+def test_read_is_not_resumed_before_enough_input():
+    conn = CountingConsumer(echo_n_bytes.__wrapped__(1000))
+    for i in range(999):
+        conn.send(b'x')
+    assert conn.resumptions == 1  # The initial get_input
+    conn.send(b'x')
+    assert conn.read() == b'x' * 1000
+
+
+def test_read_until_is_not_resumed_before_delimiter():
+    conn = CountingConsumer(readline_protocol.__wrapped__())
+    for i in range(1000):
+        conn.send(b'x')
+    assert conn.resumptions == 1
+    conn.send(b'\n')
+    assert conn.get_result() == b'x' * 1000 + b'\n'
+
+
+@ohneio.protocol(output_high_water=10, output_low_water=4)
+def pipelined_writer(frames):
+    for frame in frames:
+        yield from ohneio.write(frame)
+    return len(frames)
+
+
+def test_write_pipelines_below_high_water(buffer_class):
+    conn = pipelined_writer([b'aaaa', b'bbbb', b'cccc', b'dddd'])
+    assert b''.join(conn.read_segments()) == b'aaaabbbbcccc'
+    assert conn.is_paused
+    assert conn.writable
+
+    conn.consume(7)
+    assert conn.is_paused
+    assert b''.join(conn.read_segments()) == b'bcccc'
+
+    conn.consume(1)
+    assert not conn.is_paused
+    assert b''.join(conn.read_segments()) == b'ccccdddd'
+    assert conn.get_result() == 4
+    assert conn.read() == b'ccccdddd'
+    assert not conn.writable
+
+
+@ohneio.protocol
+def nowait_writer():
+    for i in range(3):
+        yield from ohneio.write_nowait(b'foo')
+    return 'Done'
+
+
+def test_write_nowait():
+    conn = nowait_writer()
+    assert conn.get_result() == 'Done'
+    assert conn.read() == b'foo' * 3
+
+
+def test_write_below_high_water_is_not_suspended():
+    conn = CountingConsumer(pipelined_writer.__wrapped__([b'x'] * 100), output_high_water=1000)
+    assert conn.get_result() == 100
+    assert conn.resumptions == 100  # One per write(), none for waiting
+    assert conn.read() == b'x' * 100
+
+
+def test_invalid_watermarks():
+    with pytest.raises(ValueError):
+        ohneio.Consumer(hello.__wrapped__(), output_high_water=4, output_low_water=5)
+
+
+def test_input_limit_raise():
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(100), max_input_buffer=10)
+    assert conn.input_capacity == 10
+    conn.send(b'x' * 8)
+    assert conn.input_capacity == 2
+    with pytest.raises(ohneio.LimitExceeded):
+        conn.send(b'x' * 3)
+    assert len(conn.input) == 8
+
+
+def test_input_limit_close():
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(100), max_input_buffer=10,
+                           on_input_overflow='close')
+    conn.send(b'x' * 8)
+    assert not conn.closed
+    conn.send(b'x' * 3)
+    assert conn.closed
+    assert len(conn.input) == 8
+
+
+def test_input_limit_partial(buffer_class):
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(4), max_input_buffer=10,
+                           on_input_overflow='partial')
+    conn.send(b'abcdefghijklmn')
+    assert conn.read() == b'abcdefgh'
+    assert conn.input_capacity == 8
+    assert conn.input.read() == b'ij'
+
+
+def test_reading_paused():
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(100), input_high_water=10, input_low_water=2)
+    assert conn.input_capacity is None
+    conn.send(b'x' * 8)
+    assert not conn.reading_paused
+    conn.send(b'x' * 8)
+    assert conn.reading_paused
+    conn.input.read(10)
+    assert conn.reading_paused
+    conn.input.read(4)
+    assert not conn.reading_paused
+
+
+def test_reading_paused_by_max_input_buffer():
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(100), max_input_buffer=16)
+    conn.send(b'x' * 15)
+    assert not conn.reading_paused
+    conn.send(b'x')
+    assert conn.reading_paused  # Once the buffer is full
+    conn.input.read(12)
+    assert not conn.reading_paused
+
+
+def test_invalid_input_options():
+    with pytest.raises(ValueError):
+        ohneio.Consumer(hello.__wrapped__(), input_high_water=4, input_low_water=5)
+    with pytest.raises(ValueError):
+        ohneio.Consumer(hello.__wrapped__(), input_high_water=4, input_low_water=4)
+    with pytest.raises(ValueError):
+        ohneio.Consumer(hello.__wrapped__(), on_input_overflow='ignore')
+
+
+RECORD = struct.Struct('>HIb')
+
+
+@ohneio.protocol
+def record_reader(count):
+    records = []
+    for i in range(count):
+        record = yield from ohneio.read_struct(RECORD)
+        records.append(record)
+    return records
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+def test_read_struct(segment_len, buffer_class):
+    records = [(i, i * 100000, -i) for i in range(20)]
+    data = b''.join(RECORD.pack(*record) for record in records)
+    conn = record_reader(len(records))
+    for start in range(0, len(data), segment_len):
+        conn.send(data[start:start + segment_len])
+    assert conn.get_result() == records
+
+
+@ohneio.protocol
+def body_streamer(length):
+    chunks = []
+    while length > 0:
+        chunk = yield from ohneio.read_chunk(length)
+        assert 0 < len(chunk) <= length
+        chunks.append(chunk)
+        length -= len(chunk)
+    trailer = yield from ohneio.read(3)
+    return chunks, trailer
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+def test_read_chunk(segment_len, buffer_class):
+    body = bytes(range(256)) * 4
+    data = body + b'end'
+    conn = body_streamer(len(body))
+    for start in range(0, len(data), segment_len):
+        conn.send(data[start:start + segment_len])
+        assert len(conn.input) <= max(segment_len, 3)  # The body isn't buffered
+    chunks, trailer = conn.get_result()
+    assert b''.join(chunks) == body
+    assert len(chunks) == len(range(0, len(body), segment_len))
+    assert trailer == b'end'
+
+
+def test_read_chunk_nothing_remaining():
+    conn = body_streamer(0)
+    conn.send(b'end')
+    assert conn.get_result() == ([], b'end')
+
+
+@ohneio.protocol
+def uint_reader(sizes, byteorder):
+    values = []
+    for size in sizes:
+        value = yield from ohneio.read_uint(size, byteorder)
+        values.append(value)
+    return values
+
+
+@pytest.mark.parametrize('byteorder', ['big', 'little'])
+def test_read_uint(byteorder):
+    sizes = [1, 2, 3, 4, 8, 16]
+    values = [(1 << (8 * size)) - 3 for size in sizes]
+    conn = uint_reader(sizes, byteorder)
+    for size, value in zip(sizes, values):
+        conn.send(value.to_bytes(size, byteorder))
+    assert conn.get_result() == values
+
+
+@ohneio.protocol
+def uint_pair_reader(size, byteorder):
+    first = yield from ohneio.read_uint(1)
+    second = yield from ohneio.read_uint(size, byteorder)
+    return first, second
+
+
+@pytest.mark.parametrize('size, byteorder', [(0, 'big'), (-1, 'big'), (3, 'middle')])
+def test_read_uint_invalid_size(size, byteorder):
+    conn = uint_pair_reader(size, byteorder)
+    with pytest.raises(ValueError):
+        conn.send(b'\x01\x02\x03\x04')
+    assert len(conn.input) == 3  # Nothing consumed by the invalid read
+
+
+FRAME_HEADER = struct.Struct('>BH')
+
+
+def encode_frame(kind, body):
+    return FRAME_HEADER.pack(kind, len(body)) + body
+
+
+@ohneio.protocol
+def frame_reader(count, batch=False, max_size=0):
+    frames = []
+    resumptions = 0
+    while len(frames) < count:
+        if batch:
+            new_frames = yield from ohneio.read_frames(FRAME_HEADER, length_field=1,
+                                                       max_size=max_size)
+        else:
+            new_frames = [(yield from ohneio.read_frame(FRAME_HEADER, 1, max_size=max_size))]
+        frames.extend(new_frames)
+        resumptions += 1
+    return frames, resumptions
+
+
+FRAMES = [(i % 3, bytes([i]) * i) for i in range(50)]
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+@pytest.mark.parametrize('batch', [False, True])
+def test_read_frame(segment_len, batch, buffer_class):
+    data = b''.join(encode_frame(kind, body) for kind, body in FRAMES)
+    conn = frame_reader(len(FRAMES), batch=batch)
+    for start in range(0, len(data), segment_len):
+        conn.send(data[start:start + segment_len])
+    frames, _ = conn.get_result()
+    assert frames == [((kind, len(body)), body) for kind, body in FRAMES]
+
+
+def test_read_frames_batches_complete_frames():
+    data = b''.join(encode_frame(kind, body) for kind, body in FRAMES)
+    conn = frame_reader(len(FRAMES), batch=True)
+    conn.send(data[:-1])
+    conn.send(data[-1:])
+    frames, resumptions = conn.get_result()
+    assert len(frames) == len(FRAMES)
+    assert resumptions == 2
+
+
+def test_read_frame_max_size():
+    conn = frame_reader(1, max_size=4)
+    with pytest.raises(ohneio.LimitExceeded):
+        conn.send(encode_frame(0, b'Hello'))
+
+
+@ohneio.protocol
+def signed_frame_reader():
+    while True:
+        yield from ohneio.read_frame(struct.Struct('>b'))
+
+
+def test_read_frame_negative_length():
+    conn = signed_frame_reader()
+    with pytest.raises(ValueError):
+        conn.send(b'\xfeabc\x01Z')
+    assert len(conn.input) == 6  # The stream isn't parsed past the invalid header
+
+
+@ohneio.protocol
+def deframer():
+    while True:
+        _, body = yield from ohneio.read_frame(FRAME_HEADER, length_field=1)
+        yield from ohneio.write(body)
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+def test_pipeline(segment_len, buffer_class):
+    lines = [b'foo\n', b'bar baz\n', b'\n', b'end\n']
+    data = b''.join(encode_frame(0, line[i:i + 3]) for line in lines for i in range(0, 8, 3))
+    stack = ohneio.pipeline(deframer(), line_counter(), deframer())
+    for start in range(0, len(data), segment_len):
+        stack.send(data[start:start + segment_len])
+    assert stack.has_result is False  # The last consumer never ends
+    assert stack.consumers[1].get_result() == 3
+    assert stack.read() == b''
+
+
+@ohneio.protocol
+def segments_writer(segments):
+    for segment in segments:
+        yield from ohneio.write_nowait(segment)
+
+
+def test_pipeline_moves_segments(buffer_class):
+    segments = [b'Hello', b' World']
+    stack = ohneio.pipeline(segments_writer(segments), readline_protocol())
+    stack.send(b'')
+    inner = stack.consumers[1]
+    assert len(inner.input) == 11
+    if buffer_class is ohneio.Buffer:
+        assert all(a is b for a, b in zip(inner.input.queue, segments))
+
+
+def test_pipeline_input_capacity():
+    inner = ohneio.Consumer(echo_n_bytes.__wrapped__(4), max_input_buffer=4)
+    stack = ohneio.pipeline(deframer(), inner)
+    stack.send(encode_frame(0, b'0123456789'))
+    assert len(inner.input) == 4
+    assert len(stack.consumers[0].output) == 2  # Held back until the inner consumer reads
+    assert stack.read() == b'01234567'
+    assert stack.read(1) == b''
+    stack.send(encode_frame(0, b'ab'))
+    assert stack.read() == b'89ab'
+    stack.close()
+    assert stack.closed
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+@ohneio.protocol
+def varint_reader(count, max_size=10):
+    values = []
+    for i in range(count):
+        value = yield from ohneio.read_varint(max_size)
+        values.append(value)
+    return values
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+def test_read_varint(segment_len, buffer_class):
+    values = [0, 1, 127, 128, 300, 16383, 16384, 2 ** 32, 2 ** 64 - 1]
+    data = b''.join(encode_varint(value) for value in values)
+    conn = varint_reader(len(values))
+    for start in range(0, len(data), segment_len):
+        conn.send(data[start:start + segment_len])
+    assert conn.get_result() == values
+
+
+def test_read_varint_too_long():
+    conn = varint_reader(1, max_size=2)
+    conn.send(b'\x80')
+    with pytest.raises(ohneio.LimitExceeded):
+        conn.send(b'\x80')
+
+
+def test_stats_disabled_by_default():
+    conn = echo_n_bytes(2)
+    conn.send(b'foo')
+    assert conn.stats is None
+
+
+def test_stats(buffer_class):
+    actions = []
+    conn = ohneio.Consumer(echo_n_bytes.__wrapped__(4),
+                           on_action=lambda name, elapsed: actions.append(name))
+    conn.send(b'fo')
+    conn.send(b'o')
+    conn.send(b'bar')
+    assert conn.read() == b'foob'
+    conn.send(b'baz')
+    assert conn.read() == b'arba'
+
+    stats = conn.stats
+    assert stats.bytes_in == 9
+    assert stats.bytes_out == 8
+    assert stats.peak_input_length == 6
+    assert stats.peak_input_segments == (3 if buffer_class is ohneio.Buffer else 1)
+    assert stats.peak_output_length == 4
+    assert stats.peak_output_segments == 1
+    assert stats.resumptions == len(actions)
+    assert stats.generator_time > 0
+    assert 'get_input' in actions
+    assert stats.as_dict()['bytes_in'] == 9
+
+
+@ohneio.protocol(stats=True)
+def busy_waiter():
+    while True:
+        data = yield from ohneio.peek()
+        if data.endswith(b'!'):
+            return data
+        yield from ohneio.wait()
+
+
+def test_stats_idle_wakeups():
+    conn = busy_waiter()
+    conn.send(b'foo')
+    conn.send(b'bar')
+    conn.read()
+    conn.send(b'!')
+    assert conn.get_result() == b'foobar!'
+    assert conn.stats.idle_wakeups == 2
+
+
+def failing_job(data):
+    raise ValueError(data)
+
+
+@ohneio.protocol
+def offloader(func):
+    data = yield from ohneio.read(5)
+    try:
+        result = yield from ohneio.offload(func, data)
+    except ValueError as e:
+        result = 'Failed: {}'.format(e)
+    yield from ohneio.write(b'Done')
+    return result
+
+
+def test_offload():
+    conn = offloader(lambda data: data.upper())
+    assert conn.poll_offload() is None
+    conn.send(b'hello')
+    job = conn.poll_offload()
+    assert job is not None
+    assert conn.poll_offload() is None
+    assert conn.read() == b''
+
+    conn.set_offload_result(job())
+    assert conn.read() == b'Done'
+    assert conn.get_result() == b'HELLO'
+
+
+def test_offload_exception():
+    conn = offloader(failing_job)
+    conn.send(b'hello')
+    job = conn.poll_offload()
+    with pytest.raises(ValueError) as excinfo:
+        job()
+    conn.set_offload_exception(excinfo.value)
+    assert conn.read() == b'Done'
+    assert conn.get_result() == "Failed: b'hello'"
+
+
+def test_offload_result_without_offload():
+    conn = offloader(failing_job)
+    with pytest.raises(RuntimeError):
+        conn.set_offload_result(None)
+
+
+@ohneio.protocol
+def shouter():
+    greeting = yield from ohneio.readline()
+    yield from ohneio.write(greeting.upper())
+    while not (yield from ohneio.peek()).endswith(b'!'):
+        yield from ohneio.wait()
+    data = yield from ohneio.read()
+    data = yield from ohneio.offload(bytes.upper, data)
+    yield from ohneio.write(data)
+    return len(data)
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+@pytest.mark.parametrize('checked', [True, False])
+def test_unchecked_driver(segment_len, checked, buffer_class):
+    conn = ohneio.Consumer(shouter.__wrapped__(), output_high_water=2, checked=checked)
+    assert ('_process' in vars(conn)) is not checked
+    data = b'hello\nworld!'
+    output = []
+    for start in range(0, len(data), segment_len):
+        conn.send(data[start:start + segment_len])
+        output.append(conn.read())
+    job = conn.poll_offload()
+    conn.set_offload_result(job())
+    output.append(conn.read())
+    assert b''.join(output) == b'HELLO\nWORLD!'
+    assert conn.get_result() == 6
+
+
+@ohneio.protocol
+def record_decoder():
+    while True:
+        record = yield from ohneio.read_struct(RECORD)
+        if record[0] == 0:
+            return 'Done'
+        yield from ohneio.emit(record)
+
+
+@pytest.mark.parametrize('checked', [True, False])
+def test_emit(checked):
+    records = [(i, i * 100000, -i) for i in range(1, 21)]
+    conn = ohneio.Consumer(record_decoder.__wrapped__(), checked=checked)
+    conn.send(b''.join(RECORD.pack(*record) for record in records[:15]))
+    assert conn.poll_messages(5) == records[:5]
+    conn.send(b''.join(RECORD.pack(*record) for record in records[15:]))
+    assert list(conn.messages()) == records[5:]
+    assert conn.poll_messages() == []
+    conn.send(RECORD.pack(0, 0, 0))
+    assert conn.get_result() == 'Done'
+
+
+def test_emit_max_messages():
+    records = [(i, i * 100000, -i) for i in range(1, 11)]
+    conn = CountingConsumer(record_decoder.__wrapped__(), max_messages=4)
+    conn.send(b''.join(RECORD.pack(*record) for record in records))
+    assert len(conn.input) == 6 * RECORD.size  # Suspended until messages are polled
+    resumptions = conn.resumptions
+    conn.send(RECORD.pack(0, 0, 0))
+    assert conn.resumptions == resumptions
+    assert conn.poll_messages(2) == records[:2]
+    assert conn.poll_messages() == records[2:6]
+    assert conn.poll_messages() == records[6:]
+    assert conn.get_result() == 'Done'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@ohneio.protocol
+def idle_reader(timeout):
+    lines = []
+    while True:
+        try:
+            line = yield from ohneio.with_deadline(timeout, ohneio.readline())
+        except ohneio.Timeout:
+            return lines
+        lines.append(line)
+
+
+@ohneio.protocol
+def ticker():
+    for i in range(3):
+        yield from ohneio.sleep(1.5)
+        yield from ohneio.write_nowait(str(i).encode('ascii'))
+    return 'Done'
+
+
+@pytest.mark.parametrize('checked', [True, False])
+def test_sleep(checked):
+    clock = FakeClock()
+    conn = ohneio.Consumer(ticker.__wrapped__(), clock=clock, checked=checked)
+    assert conn.next_deadline() == 101.5
+    clock.now = 101.0
+    assert conn.tick() == 101.5
+    assert conn.read() == b''
+    assert conn.tick(102.0) == 103.5  # The next sleep starts at the given time
+    assert conn.read() == b'0'
+    clock.now = 200.0
+    conn.send(b'ignored')  # Deadlines are also checked by the other actions
+    assert conn.read() == b'1'
+    assert conn.next_deadline() == 201.5
+    assert conn.tick(201.5) is None
+    assert conn.read() == b'2'
+    assert conn.get_result() == 'Done'
+
+
+@pytest.mark.parametrize('checked', [True, False])
+def test_with_deadline(checked):
+    clock = FakeClock()
+    conn = ohneio.Consumer(idle_reader.__wrapped__(10), clock=clock, checked=checked)
+    assert conn.next_deadline() == 110.0
+    clock.now = 105.0
+    conn.send(b'foo\n')
+    assert conn.next_deadline() == 115.0
+    conn.send(b'bar')
+    clock.now = 114.0
+    assert conn.tick() == 115.0
+    assert not conn.has_result
+    conn.send(b'\nbaz')
+    clock.now = 124.0
+    assert conn.tick() is None
+    assert conn.get_result() == [b'foo\n', b'bar\n']
+
+
+@ohneio.protocol
+def slow_writer():
+    yield from ohneio.with_deadline(5, ohneio.write(b'Hello'))
+    yield from ohneio.with_deadline(5, ohneio.wait())
+    return 'Done'
+
+
+def test_with_deadline_unhandled():
+    clock = FakeClock()
+    conn = ohneio.Consumer(slow_writer.__wrapped__(), clock=clock)
+    assert conn.next_deadline() == 105.0  # write() waits for the output to be read
+    assert conn.read(2) == b'He'
+    with pytest.raises(ohneio.Timeout):
+        conn.tick(105.0)
+
+
+def test_with_deadline_wait():
+    clock = FakeClock()
+    conn = ohneio.Consumer(slow_writer.__wrapped__(), clock=clock)
+    assert conn.read() == b'Hello'
+    assert conn.next_deadline() == 105.0
+    clock.now = 104.0
+    assert conn.tick() == 105.0
+    conn.send(b'x')  # Resumes wait()
+    assert conn.get_result() == 'Done'
+
+
+def test_send_many():
+    conn = CountingConsumer(readline_protocol.__wrapped__())
+    conn.send_many([b'foo'] * 100 + [b'\n'])
+    assert conn.resumptions == 1
+    assert conn.get_result() == b'foo' * 100 + b'\n'
+
+
+def test_send_many_limit_raise():
+    conn = ohneio.Consumer(readline_protocol.__wrapped__(), max_input_buffer=10)
+    with pytest.raises(ohneio.LimitExceeded):
+        conn.send_many(iter([b'foo', b'\n', b'bar', b'bazqux']))
+    assert len(conn.input) == 0  # Nothing accepted, like send()
+    conn.send_many(iter([b'foo', b'\n']))
+    assert conn.get_result() == b'foo\n'
+
+
+def test_send_many_limit():
+    conn = ohneio.Consumer(readline_protocol.__wrapped__(), max_input_buffer=10,
+                           on_input_overflow='close')
+    conn.send_many([b'foo'] * 5)
+    assert conn.closed
+    assert len(conn.input) == 9
+
+
+@ohneio.protocol
+def line_counter():
+    lines = 0
+    while True:
+        line = yield from ohneio.readline()
+        if line == b'end\n':
+            return lines
+        lines += 1
+
+
+@pytest.mark.parametrize('chunk_size', BUFFER_SIZES)
+def test_feed_stream(chunk_size, buffer_class):
+    data = b'line\n' * 100 + b'end\ntrailing data'
+    conn = line_counter()
+    fed = conn.feed_stream(io.BytesIO(data), chunk_size)
+    assert conn.get_result() == 100
+    assert fed >= data.index(b'end\n') + 4
+
+
+def test_feed_stream_full_input():
+    data = b'line\n' * 10
+    conn = ohneio.Consumer(echo.__wrapped__(), max_input_buffer=8)
+    stream = io.BytesIO(data)
+    assert conn.feed_stream(stream, 4) == 13  # The protocol waits for its output to be read
+    assert conn.input_capacity == 0
+    assert not conn.closed
+    output = []
+    while conn.input_capacity == 0:
+        output.append(conn.read())
+        conn.feed_stream(stream, 4)
+    assert conn.input_capacity > 0  # The end of the file
+    output.append(conn.read())
+    assert b''.join(output) == data
+
+
+def test_feed_stream_without_readinto():
+    class Stream:
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+
+        def read(self, size):
+            return self.data.read(size)
+
+    conn = line_counter()
+    assert conn.feed_stream(Stream(b'foo\nbar\nend\n'), 3) == 12
+    assert conn.get_result() == 2
+
+
+@ohneio.protocol
+def mmap_records():
+    records = []
+    while True:
+        line = yield from ohneio.readline()
+        if line == b'end\n':
+            break
+        kind, = yield from ohneio.read_struct(RECORD_KIND)
+        length = yield from ohneio.read_varint()
+        body = yield from ohneio.read(length)
+        records.append((bytes(line), kind, body))
+    return records
+
+
+RECORD_KIND = struct.Struct('>H')
+
+
+def test_from_mmap(tmp_path):
+    records = [(b'first\n', 1, b'Hello'), (b'second\n', 2, b'x' * 300)]
+    path = tmp_path / 'records'
+    path.write_bytes(b''.join(line + RECORD_KIND.pack(kind) + encode_varint(len(body)) + body
+                              for line, kind, body in records) + b'end\n')
+
+    conn = mmap_records.from_mmap(str(path))
+    result = conn.get_result()
+    assert result == records
+    for _, _, body in result:
+        assert isinstance(body, memoryview)
+        assert body.obj is conn.input.mmap
+
+
+def test_from_mmap_closes_mapping(tmp_path):
+    path = tmp_path / 'lines'
+    path.write_bytes(b'foo\nbar\n')
+    pool = ohneio.BufferPool()
+    conn = ohneio.Consumer.from_mmap(line_counter.__wrapped__(), str(path), pool=pool)
+    assert pool.misses == 1  # Only the output is taken from the pool
+    assert conn.input.mmap is not None
+    conn.close()
+    assert conn.input.mmap is None
+    assert len(pool) == 1
+
+    path.write_bytes(b'foo\nend\n')
+    conn = line_counter.from_mmap(str(path))
+    assert conn.get_result() == 1
+    assert conn.input.mmap is None  # Closed once the protocol ended
+
+
+def test_mmap_buffer(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(b'Hello World')
+    buf = ohneio.MmapBuffer(str(path))
+    assert buf.peek(5) == b'Hello'
+    assert buf.read(6) == b'Hello '
+    assert buf.find(b'rl') == 2
+    assert bytes(buf.read()) == b'World'
+    buf.close()
+    assert buf.mmap is None
+
+
+def test_from_mmap_empty_file(tmp_path):
+    path = tmp_path / 'empty'
+    path.write_bytes(b'')
+    conn = ohneio.Consumer.from_mmap(mmap_records.__wrapped__(), str(path))
+    assert not conn.has_result
+    assert len(conn.input) == 0
+
+
 def wait_for(s):
     while True:
         data = yield from ohneio.peek()
@@ -89,7 +1149,7 @@ def line_reader():
     (b'hello\n', b'hello'),
     (b'hello\nhello', b'hello'),
 ])
-def test_line_reader(segment_len, input_, expected):
+def test_line_reader(segment_len, input_, expected, buffer_class):
     conn = line_reader()
 
     for start in range(0, len(input_) + 1, segment_len):
@@ -107,6 +1167,84 @@ def test_line_reader_no_result():
     assert not conn.has_result
 
 
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+@pytest.mark.parametrize('sub', [b'a', b'ab', b'cde', b'deadbeef', b'x'])
+def test_buffer_find(segment_len, sub, buffer_class):
+    data = b'0123abcdefghi0123deadbeef'
+    buf = buffer_class()
+    buf.write(b'???')
+    for start in range(0, len(data), segment_len):
+        buf.write(data[start:start + segment_len])
+    buf.read(3)
+
+    assert buf.find(sub) == data.find(sub)
+    for start in range(len(data)):
+        for end in range(start, len(data) + 1, 5):
+            assert buf.find(sub, start, end) == data.find(sub, start, end)
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+@pytest.mark.parametrize('sub', [b'0', b'de', b'deadbeef', b'ghi0123d'])
+def test_buffer_find_cursor(segment_len, sub):
+    data = b'0123abcdefghi0123deadbeef'
+    buf = ohneio.Buffer()
+    buf.write(b'???')
+    buf.read(2)
+    buf.write(memoryview(b'?'))
+    scanned = 0
+    cursor = None
+    for start in range(0, len(data), segment_len):
+        buf.write(memoryview(data[start:start + segment_len]))
+        # Resume the search where it was left, like read_until()
+        pos, cursor = buf._find(sub, max(scanned - len(sub) + 1, 0), len(buf), cursor)
+        scanned = len(buf)
+        if pos >= 0:
+            break
+    assert pos == data.find(sub) + 2
+
+
+@ohneio.protocol
+def delimited_reader(delimiter, max_size=0):
+    lines = []
+    while True:
+        line = yield from ohneio.read_until(delimiter, max_size=max_size)
+        if line == delimiter:
+            return lines
+        lines.append(line)
+
+
+@pytest.mark.parametrize('segment_len', BUFFER_SIZES)
+@pytest.mark.parametrize('delimiter', [b'\n', b'\r\n', b'--boundary--'])
+def test_read_until(segment_len, delimiter, buffer_class):
+    lines = [b'hello' + delimiter, b'world' * 30 + delimiter, b'!' + delimiter]
+    input_ = b''.join(lines) + delimiter + b'trailing'
+    conn = delimited_reader(delimiter)
+    for start in range(0, len(input_), segment_len):
+        conn.send(input_[start:start + segment_len])
+    assert conn.get_result() == lines
+
+
+def test_read_until_max_size():
+    conn = delimited_reader(b'\n', max_size=6)
+    conn.send(b'hello\n')
+    conn.send(b'hello')
+    with pytest.raises(ohneio.LimitExceeded):
+        conn.send(b'!\n')
+
+
+@ohneio.protocol
+def readline_protocol():
+    line = yield from ohneio.readline()
+    return line
+
+
+def test_readline():
+    conn = readline_protocol()
+    conn.send(b'foo')
+    conn.send(b'bar\nbaz')
+    assert conn.get_result() == b'foobar\n'
+
+
 @ohneio.protocol
 def echo():
     while True:
@@ -116,7 +1254,7 @@ def echo():
         yield from ohneio.write(LINE_SEPARATOR)
 
 
-def test_echo():
+def test_echo(buffer_class):
     conn = echo()
     conn.send(b'hello')
     assert conn.read() == b''
@@ -0,0 +1,319 @@
+import asyncio
+import concurrent.futures
+import gc
+import socket
+import zlib
+
+import pytest
+
+import ohneio
+import ohneio.asyncio
+
+
+@ohneio.protocol
+def echo_until_quit():
+    lines = 0
+    while True:
+        line = yield from ohneio.readline()
+        if line == b'quit\n':
+            return lines
+        yield from ohneio.write(line)
+        lines += 1
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_consumer_protocol(loop):
+    server_sock, client_sock = socket.socketpair()
+
+    async def client():
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        writer.write(b'hello\nwor')
+        assert await reader.readline() == b'hello\n'
+        writer.write(b'ld\nquit\n')
+        assert await reader.readline() == b'world\n'
+        assert await reader.read() == b''
+        writer.close()
+
+    async def main():
+        _, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(echo_until_quit(), loop=loop),
+            sock=server_sock)
+        await client()
+        return await protocol.result
+
+    assert loop.run_until_complete(main()) == 2
+
+
+def test_consumer_protocol_flow_control(loop):
+    server_sock, client_sock = socket.socketpair()
+    line = b'x' * 1023 + b'\n'
+
+    async def main():
+        transport, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(echo_until_quit(), loop=loop),
+            sock=server_sock)
+        transport.set_write_buffer_limits(high=4096)
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        writer.write(line * 100)
+        await asyncio.sleep(0.01)
+        writer.write(b'quit\n')
+        data = await reader.read()
+        writer.close()
+        return data, await protocol.result
+
+    data, result = loop.run_until_complete(main())
+    assert data == line * 100
+    assert result == 100
+
+
+@pytest.mark.parametrize('on_input_overflow', ['raise', 'partial'])
+def test_consumer_protocol_input_burst(loop, on_input_overflow):
+    server_sock, client_sock = socket.socketpair()
+    lines = b'x' * 19 + b'\n'
+
+    async def main():
+        consumer = ohneio.Consumer(echo_until_quit.__wrapped__(), max_input_buffer=64,
+                                   on_input_overflow=on_input_overflow)
+        _, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(consumer, loop=loop), sock=server_sock)
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        writer.write(lines * 10 + b'quit\n')  # Way above the input buffer limit
+        data = await reader.read()
+        writer.close()
+        return data, await protocol.result
+
+    data, result = loop.run_until_complete(main())
+    assert data == lines * 10
+    assert result == 10
+
+
+def test_consumer_protocol_input_limit(loop):
+    server_sock, client_sock = socket.socketpair()
+
+    async def main():
+        _, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(
+                ohneio.Consumer(echo_until_quit.__wrapped__(), max_input_buffer=16), loop=loop),
+            sock=server_sock)
+        client_sock.sendall(b'x' * 32)  # No line fits in the input buffer
+        try:
+            await protocol.result
+        finally:
+            client_sock.close()
+
+    with pytest.raises(ohneio.LimitExceeded):
+        loop.run_until_complete(main())
+
+
+class FakeTransport:
+    def __init__(self):
+        self.data = bytearray()
+        self.reading = True
+
+    def write(self, data):
+        self.data.extend(data)
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('options', [{'max_input_buffer': 16},
+                                     {'max_input_buffer': 16, 'input_high_water': 0}])
+def test_consumer_protocol_pauses_reading(loop, options):
+    @ohneio.protocol(**options)
+    def reader():
+        while True:
+            data = yield from ohneio.read(16)
+            yield from ohneio.offload(len, data)
+
+    transport = FakeTransport()
+    protocol = ohneio.asyncio.ConsumerProtocol(reader(), loop=loop)
+    protocol.connection_made(transport)
+    protocol.data_received(b'x' * 16)  # Waiting for the offloaded function
+    protocol.data_received(b'x' * 16)
+    assert not transport.reading
+    assert not protocol.result.done()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert transport.reading
+
+
+def test_consumer_protocol_connection_lost(loop):
+    server_sock, client_sock = socket.socketpair()
+
+    async def main():
+        _, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(echo_until_quit(), loop=loop),
+            sock=server_sock)
+        client_sock.sendall(b'incomplete')
+        client_sock.close()
+        await protocol.result
+
+    with pytest.raises(ohneio.NoResult):
+        loop.run_until_complete(main())
+
+
+def test_consumer_protocol_connection_lost_releases(loop):
+    pool = ohneio.BufferPool()
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+    async def main():
+        server_sock, client_sock = socket.socketpair()
+        consumer = ohneio.Consumer(echo_until_quit.__wrapped__(), pool=pool)
+        await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(consumer, loop=loop), sock=server_sock)
+        client_sock.sendall(b'incomplete')
+        client_sock.close()
+        await asyncio.sleep(0.05)
+        return consumer
+
+    consumer = loop.run_until_complete(main())
+    assert consumer.closed
+    assert len(pool) == 2
+    del consumer
+    gc.collect()
+    assert errors == []  # The NoResult of the result wasn't awaited, but isn't logged
+
+
+def test_run_protocol(loop):
+    server_sock, client_sock = socket.socketpair()
+
+    async def main():
+        reader, writer = await asyncio.open_connection(sock=server_sock)
+        client_sock.sendall(b'foo\nbar\nquit\n')
+        result = await ohneio.asyncio.run_protocol(echo_until_quit, reader, writer)
+        writer.close()
+        return result
+
+    assert loop.run_until_complete(main()) == 2
+    assert client_sock.recv(1024) == b'foo\nbar\n'
+    client_sock.close()
+
+
+def test_run_protocol_end_of_stream(loop):
+    server_sock, client_sock = socket.socketpair()
+
+    async def main():
+        reader, writer = await asyncio.open_connection(sock=server_sock)
+        client_sock.sendall(b'foo')
+        client_sock.close()
+        try:
+            await ohneio.asyncio.run_protocol(echo_until_quit, reader, writer)
+        finally:
+            writer.close()
+
+    with pytest.raises(ohneio.NoResult):
+        loop.run_until_complete(main())
+
+
+@ohneio.protocol
+def inflate():
+    while True:
+        length = yield from ohneio.read_uint(4)
+        if length == 0:
+            return 'Done'
+        data = yield from ohneio.read(length)
+        try:
+            data = yield from ohneio.offload(zlib.decompress, data)
+        except zlib.error:
+            data = b'error'
+        yield from ohneio.write(data)
+
+
+def compressed_message(data):
+    data = zlib.compress(data)
+    return len(data).to_bytes(4, 'big') + data
+
+
+def test_consumer_protocol_offload(loop):
+    server_sock, client_sock = socket.socketpair()
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    async def main():
+        _, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(inflate(), loop=loop, executor=executor),
+            sock=server_sock)
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        writer.write(compressed_message(b'Hello ') + b'\x00\x00\x00\x03foo' +
+                     compressed_message(b'World') + bytes(4))
+        data = await reader.read()
+        writer.close()
+        return data, await protocol.result
+
+    try:
+        assert loop.run_until_complete(main()) == (b'Hello errorWorld', 'Done')
+    finally:
+        executor.shutdown()
+
+
+def test_run_protocol_offload(loop):
+    server_sock, client_sock = socket.socketpair()
+
+    async def main():
+        reader, writer = await asyncio.open_connection(sock=server_sock)
+        client_sock.sendall(compressed_message(b'Hello') + bytes(4))
+        result = await ohneio.asyncio.run_protocol(inflate, reader, writer)
+        writer.close()
+        return result
+
+    assert loop.run_until_complete(main()) == 'Done'
+    assert client_sock.recv(1024) == b'Hello'
+    client_sock.close()
+
+
+@ohneio.protocol
+def delayed_greeter():
+    name = yield from ohneio.with_deadline(0.5, ohneio.readline())
+    yield from ohneio.sleep(0.02)
+    yield from ohneio.write(b'Hello ' + name)
+    return name
+
+
+def test_consumer_protocol_timers(loop):
+    async def main(data):
+        server_sock, client_sock = socket.socketpair()
+        _, protocol = await loop.create_connection(
+            lambda: ohneio.asyncio.ConsumerProtocol(delayed_greeter(), loop=loop),
+            sock=server_sock)
+        reader, writer = await asyncio.open_connection(sock=client_sock)
+        writer.write(data)
+        try:
+            return await asyncio.wait_for(protocol.result, 2), await reader.read()
+        finally:
+            writer.close()
+
+    assert loop.run_until_complete(main(b'World\n')) == (b'World\n', b'Hello World\n')
+    with pytest.raises(ohneio.Timeout):
+        loop.run_until_complete(main(b'World'))
+
+
+def test_run_protocol_timers(loop):
+    async def main(data):
+        server_sock, client_sock = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=server_sock)
+        client_sock.sendall(data)
+        try:
+            return await asyncio.wait_for(
+                ohneio.asyncio.run_protocol(delayed_greeter, reader, writer), 2)
+        finally:
+            writer.close()
+            client_sock.close()
+
+    assert loop.run_until_complete(main(b'World\n')) == b'World\n'
+    with pytest.raises(ohneio.Timeout):
+        loop.run_until_complete(main(b'World'))
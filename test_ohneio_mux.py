@@ -0,0 +1,233 @@
+import os
+import socket
+import tempfile
+
+import pytest
+
+import ohneio
+import ohneio.mux
+
+
+@ohneio.protocol
+def echo_until_quit():
+    lines = 0
+    while True:
+        line = yield from ohneio.readline()
+        if line == b'quit\n':
+            return lines
+        yield from ohneio.write(line)
+        lines += 1
+
+
+@pytest.fixture
+def mux():
+    mux = ohneio.mux.Multiplexer(recv_size=7)
+    yield mux
+    mux.close()
+
+
+def run_until(mux, condition):
+    for i in range(1000):
+        if condition():
+            return
+        mux.run_once(timeout=1)
+    raise AssertionError("Condition never met")
+
+
+def test_register(mux):
+    done = []
+    server_sock, client_sock = socket.socketpair()
+    mux.register(server_sock, echo_until_quit(), lambda consumer, exc: done.append((consumer, exc)))
+
+    client_sock.sendall(b'hello\nworld\n')
+    received = bytearray()
+
+    def echoed():
+        received.extend(client_sock.recv(1024))
+        return received == b'hello\nworld\n'
+
+    client_sock.setblocking(False)
+    run_until(mux, lambda: _try(echoed))
+    client_sock.sendall(b'quit\n')
+    run_until(mux, lambda: done)
+
+    consumer, exc = done[0]
+    assert exc is None
+    assert consumer.get_result() == 2
+    assert mux.connections == {}
+    assert client_sock.recv(1024) == b''
+    client_sock.close()
+
+
+def _try(func):
+    try:
+        return func()
+    except BlockingIOError:
+        return False
+
+
+def test_peer_closed(mux):
+    done = []
+    server_sock, client_sock = socket.socketpair()
+    mux.register(server_sock, echo_until_quit(), lambda consumer, exc: done.append(exc))
+    client_sock.sendall(b'incomplete')
+    client_sock.close()
+    run_until(mux, lambda: done)
+    assert isinstance(done[0], ohneio.NoResult)
+
+
+def test_protocol_error(mux):
+    done = []
+    server_sock, client_sock = socket.socketpair()
+    consumer = ohneio.Consumer(echo_until_quit.__wrapped__(), max_input_buffer=4)
+    mux.register(server_sock, consumer, lambda consumer, exc: done.append(exc))
+    client_sock.sendall(b'too long')
+    run_until(mux, lambda: done)
+    assert isinstance(done[0], ohneio.LimitExceeded)
+    client_sock.close()
+
+
+@ohneio.protocol
+def banner():
+    yield from ohneio.write(b'Welcome\n')
+    return (yield from ohneio.readline())
+
+
+def test_write_first(mux):
+    done = []
+    server_sock, client_sock = socket.socketpair()
+    consumer = banner()
+    assert consumer.writable  # Even though the consumer wasn't given any input yet
+    mux.register(server_sock, consumer, lambda consumer, exc: done.append((consumer, exc)))
+    peek_flags = socket.MSG_PEEK | socket.MSG_DONTWAIT
+    run_until(mux, lambda: _try(lambda: client_sock.recv(1024, peek_flags)))
+    assert client_sock.recv(1024) == b'Welcome\n'
+    client_sock.sendall(b'hello\n')
+    run_until(mux, lambda: done)
+    assert done[0][1] is None
+    assert done[0][0].get_result() == b'hello\n'
+    client_sock.close()
+
+
+@ohneio.protocol
+def failing():
+    yield from ohneio.wait()
+    raise ValueError("Broken protocol")
+
+
+def test_protocol_exception(mux):
+    done = []
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    factories = iter([failing, echo_until_quit])
+
+    def factory():
+        return next(factories)()  # StopIteration once there are no more protocols
+
+    mux.listen(listener, factory, lambda consumer, exc: done.append(exc))
+    first = socket.create_connection(listener.getsockname())
+    first.sendall(b'x')
+    run_until(mux, lambda: done)
+    assert isinstance(done[0], ValueError)  # Not raised by run_once()
+
+    second = socket.create_connection(listener.getsockname())
+    second.sendall(b'quit\n')
+    run_until(mux, lambda: len(done) == 2)
+    assert done[1] is None
+
+    third = socket.create_connection(listener.getsockname())
+    third.setblocking(False)
+    run_until(mux, lambda: _try(lambda: third.recv(1024) == b''))  # The factory raised
+    for sock in (first, second, third):
+        sock.close()
+
+
+def test_listen(mux):
+    done = []
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    mux.listen(listener, echo_until_quit, lambda consumer, exc: done.append(consumer))
+
+    clients = [socket.create_connection(listener.getsockname()) for i in range(5)]
+    for i, client in enumerate(clients):
+        client.sendall(b'line\n' * i + b'quit\n')
+    run_until(mux, lambda: len(done) == len(clients))
+
+    assert sorted(consumer.get_result() for consumer in done) == list(range(len(clients)))
+    for i, client in enumerate(clients):
+        data = b''
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        assert data == b'line\n' * i
+        client.close()
+
+
+@ohneio.protocol
+def file_server(fileobj):
+    yield from ohneio.write(b'<')
+    yield from ohneio.write_file(fileobj, 1, 100000)
+    yield from ohneio.write_nowait(b'>')
+    yield from ohneio.write_file(fileobj, 0, 1)
+    return 'Done'
+
+
+def test_sendfile(mux, monkeypatch):
+    calls = []
+    sendfile = os.sendfile
+
+    def counting_sendfile(*args):
+        calls.append(args[2:])
+        return sendfile(*args)
+
+    monkeypatch.setattr(os, 'sendfile', counting_sendfile)
+    done = []
+    content = bytes(range(256)) * 1000
+    server_sock, client_sock = socket.socketpair()
+    with tempfile.TemporaryFile() as fp:
+        fp.write(content)
+        fp.flush()
+        mux.register(server_sock, file_server(fp), lambda consumer, exc: done.append(exc))
+
+        received = bytearray()
+        while True:
+            mux.run_once(timeout=1)
+            chunk = client_sock.recv(1 << 20)
+            if not chunk:
+                break
+            received.extend(chunk)
+    assert done == [None]
+    assert received == b'<' + content[1:100001] + b'>' + content[:1]
+    assert calls[0] == (1, 100000)
+    assert calls[-1] == (0, 1)
+    client_sock.close()
+
+
+@ohneio.protocol
+def delayed_greeter():
+    name = yield from ohneio.with_deadline(0.05, ohneio.readline())
+    yield from ohneio.sleep(0.01)
+    yield from ohneio.write(b'Hello ' + name)
+    return name
+
+
+def test_timers(mux):
+    done = []
+    server_sock, client_sock = socket.socketpair()
+    mux.register(server_sock, delayed_greeter(), lambda consumer, exc: done.append(exc))
+    client_sock.sendall(b'World\n')
+    run_until(mux, lambda: done)
+    assert done == [None]
+    assert client_sock.recv(1024) == b'Hello World\n'
+    client_sock.close()
+
+    server_sock, client_sock = socket.socketpair()
+    mux.register(server_sock, delayed_greeter(), lambda consumer, exc: done.append(exc))
+    mux.run(timeout=1)  # Returns once the idle connection timed out
+    assert isinstance(done[1], ohneio.Timeout)
+    assert mux.connections == {}
+    client_sock.close()
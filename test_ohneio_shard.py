@@ -0,0 +1,70 @@
+import socket
+import time
+
+import pytest
+
+import ohneio
+import ohneio.shard
+
+
+@ohneio.protocol
+def echo_until_quit():
+    while True:
+        line = yield from ohneio.readline()
+        if line == b'quit\n':
+            return
+        yield from ohneio.write(line)
+
+
+def request(address, data):
+    with socket.create_connection(address, timeout=10) as sock:
+        sock.sendall(data + b'quit\n')
+        received = b''
+        while True:
+            chunk = sock.recv(1024)
+            if not chunk:
+                return received
+            received += chunk
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition never met")
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('reuse_port', [False, True])
+def test_sharded_server(reuse_port):
+    with ohneio.shard.ShardedServer(echo_until_quit, ('127.0.0.1', 0), workers=2,
+                                    reuse_port=reuse_port) as server:
+        for i in range(10):
+            data = 'line {}\n'.format(i).encode('ascii')
+            assert request(server.address, data) == data
+
+        wait_for(lambda: sum(worker['completed'] for worker in server.load()) == 10)
+        assert all(worker['alive'] for worker in server.load())
+
+
+def test_sharded_server_restart():
+    with ohneio.shard.ShardedServer(echo_until_quit, ('127.0.0.1', 0), workers=2) as server:
+        assert server.check() == []
+        pid = server.processes[0].pid
+        server.processes[0].terminate()
+        server.processes[0].join()
+
+        assert server.check() == [0]
+        assert server.processes[0].pid != pid
+        for i in range(4):
+            assert request(server.address, b'hello\n') == b'hello\n'
+
+
+def test_sharded_server_load():
+    with ohneio.shard.ShardedServer(echo_until_quit, ('127.0.0.1', 0), workers=2) as server:
+        clients = [socket.create_connection(server.address) for i in range(6)]
+        try:
+            wait_for(lambda: sum(worker['connections'] for worker in server.load()) == 6)
+        finally:
+            for client in clients:
+                client.close()